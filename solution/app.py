@@ -2,17 +2,27 @@
 # This file provides code for our node to interface with you and other nodes (called peers).
 # We use RESTful communication with HTTP endpoints to accomplish this.
 
-from flask import Flask, request
+from flask import Flask, request, Response
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 import requests
 import json
 import logging
-import sys
+import argparse
 import threading
 import signal
+import gzip
+from hashlib import sha256
 from logging.config import dictConfig
 
 from node import Node
-from blockchain import Block
+from mempool import valid_amount
+from blockchain import Block, signature_cache, public_key_cache, PUBLIC_KEY_CACHE_SIZE, load_transaction
+from cache import LRUCache
+import wire
+import compact
+import network
+from relay import RelayQueue, TransactionRelayQueue
 
 # configures logging to be prettier, adds datetime and level
 dictConfig({
@@ -34,6 +44,8 @@ logger = logging.getLogger()
 
 # create our Flask app. Flask provides easy RESTful support for Python.
 app =  Flask('app')
+# requests bigger than this are rejected before we read them
+app.config['MAX_CONTENT_LENGTH'] = wire.MAX_MESSAGE_SIZE
 
 # create a node object. Node will provide most of our blockchain's functionality.
 node = Node()
@@ -45,6 +57,256 @@ peers = []
 # this flag stores the state of our miner. If miner is running this is True
 mining = False
 
+# the maximum number of blocks returned by one call to /blocks
+MAX_BLOCKS_PER_REQUEST = 500
+# and by one call to /headers
+MAX_HEADERS_PER_REQUEST = 2000
+# the maximum number of transactions created by one call to /new_transactions
+MAX_TRANSACTIONS_PER_REQUEST = 1000
+
+# content type of streamed responses: one JSON document per line
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+# the content type we send blocks to peers with, set by --wire-format. Peers that don't understand it
+# get JSON, which every node supports
+WIRE_FORMATS = {'json': 'application/json',
+                'binary': wire.BINARY_CONTENT_TYPE,
+                'zlib': wire.COMPRESSED_CONTENT_TYPE}
+wire_content_type = wire.BINARY_CONTENT_TYPE
+# peers that rejected our binary format, we only send them JSON
+json_only_peers = set()
+
+# the address peers reach us at, set by --address. New blocks are announced by hash along with this address,
+# and peers download the ones they don't have from us. Without it we announce the port we listen on, set by
+# app.py's main, and peers download from the host our announcement came from. If we know neither, or a peer
+# can't download from us, we send whole blocks instead
+node_address = None
+node_port = None
+# the last UNREACHABLE_SOURCES_SIZE addresses we couldn't download announced blocks from, they are tried last
+UNREACHABLE_SOURCES_SIZE = 1000
+unreachable_sources = LRUCache(UNREACHABLE_SOURCES_SIZE)
+# a failed download may just be a network blip, so the peers below go back to announcements by hash after
+# ANNOUNCE_RETRY_INTERVAL seconds
+ANNOUNCE_RETRY_INTERVAL = 600
+# peers that don't support announcements by hash or can't download blocks from us, we send them whole blocks
+push_only_peers = LRUCache(UNREACHABLE_SOURCES_SIZE, ttl=ANNOUNCE_RETRY_INTERVAL)
+# announcers (see announcer_id) we couldn't download blocks from. We ask them to send whole blocks instead
+unreachable_announcers = LRUCache(UNREACHABLE_SOURCES_SIZE, ttl=ANNOUNCE_RETRY_INTERVAL)
+
+# peers that don't serve compact blocks, we download whole blocks from them
+full_block_peers = set()
+# counters of the blocks we downloaded as compact blocks, the transactions we had to ask for and the blocks we
+# downloaded whole instead
+compact_stats = {'compact_blocks': 0, 'missing_transactions': 0, 'full_blocks': 0}
+
+# hashes of the most recent blocks we've heard of. Announcements of these blocks are ignored right away, without
+# downloading or parsing anything. In a network where every node talks to many peers we hear of each block many times
+SEEN_BLOCKS_SIZE = 10000
+seen_blocks = LRUCache(SEEN_BLOCKS_SIZE)
+
+# the bodies of our most popular responses (like /info and /balances) are cached, so polling them doesn't rebuild the
+# same JSON over and over. Cache keys include our last block hash or the transaction pool version, so a new block or
+# transaction simply moves on to new entries. Bodies of at least GZIP_MIN_SIZE bytes are sent gzipped to callers
+# that accept it. The cache holds at most RESPONSE_CACHE_BYTES of bodies (and their gzipped copies), bodies bigger
+# than MAX_CACHED_BODY_SIZE (like a whole blockchain from /info) are built for each request and never kept
+RESPONSE_CACHE_SIZE = 32
+RESPONSE_CACHE_BYTES = 16 * 1024 * 1024
+MAX_CACHED_BODY_SIZE = 1024 * 1024
+response_cache = LRUCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_BYTES)
+GZIP_MIN_SIZE = 1024
+
+# announced blocks are downloaded in the background by these threads, so announcing a block doesn't wait for it
+inventory_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='inventory')
+
+# negotiate_content_type picks the content type of our response from the request's Accept header. JSON comes
+# first, so callers that accept anything (like browsers) get JSON
+def negotiate_content_type():
+    return request.accept_mimetypes.best_match(('application/json',) + wire.BINARY_CONTENT_TYPES, 'application/json')
+
+# chain_response creates a response with our blockchain size, a list of peers and a list of blocks, in the
+# format the caller asked for. chain is the version of our blockchain the blocks come from
+def chain_response(peer_list, blocks, chain):
+    content_type = negotiate_content_type()
+    return Response(chain_body(peer_list, blocks, chain, content_type), content_type=content_type)
+
+# chain_body encodes our blockchain size, a list of peers and a list of blocks as content_type, see chain_response
+def chain_body(peer_list, blocks, chain, content_type):
+    chain_size = chain.get_blockchain_size()
+    if content_type in wire.BINARY_CONTENT_TYPES:
+        return wire.encode_chain(chain_size, peer_list, blocks, compress=(content_type == wire.COMPRESSED_CONTENT_TYPE))
+    return json.dumps({'chain_size': chain_size,                       
+                       'peers': peer_list,
+                       'blocks': [str(block) for block in blocks]})
+
+# tip_hash returns the hash of the last block of chain, it identifies the version of our blockchain
+def tip_hash(chain):
+    if chain.get_blockchain_size() == 0:
+        return None
+    return chain.get_last_block().hash
+
+# cached_response returns a response with the body built by build (a string or bytes), cached under key. The key
+# should change whenever the body does. Responses have an ETag: callers sending it back in If-None-Match get
+# an empty 304 response if the body didn't change. Callers that accept gzip get big bodies compressed
+def cached_response(key, build, content_type='application/json'):
+    entry = response_cache.get(key)
+    if entry is None:
+        body = build()
+        if isinstance(body, str):
+            body = body.encode()
+        entry = {'body': body, 'etag': sha256(body).hexdigest()[:32], 'gzip': None}
+        if len(body) <= MAX_CACHED_BODY_SIZE:
+            response_cache.put(key, entry, len(body))
+
+    # the caller already has this body
+    if request.if_none_match.contains(entry['etag']):
+        response = Response(status=304)
+    elif request.accept_encodings['gzip'] and len(entry['body']) >= GZIP_MIN_SIZE:
+        # compress it the first time someone asks for it
+        if entry['gzip'] is None:
+            entry['gzip'] = gzip.compress(entry['body'])
+            # the cache keeps both copies now
+            if len(entry['body']) <= MAX_CACHED_BODY_SIZE:
+                response_cache.put(key, entry, len(entry['body']) + len(entry['gzip']))
+        response = Response(entry['gzip'], content_type=content_type)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(entry['body'], content_type=content_type)
+    response.set_etag(entry['etag'])
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# read_chain_response reads a response created by chain_response on a peer, blocks are returned as Block objects
+def read_chain_response(response):
+    content_type = response.headers.get('Content-Type', '').split(';')[0]
+    if content_type in wire.BINARY_CONTENT_TYPES:
+        return wire.decode_chain(response.content, compressed=(content_type == wire.COMPRESSED_CONTENT_TYPE))
+    chain = response.json()
+    blocks = []
+    for block_data in chain['blocks']:
+        block = Block()
+        block.load_from(json.loads(block_data))
+        blocks.append(block)
+    chain['blocks'] = blocks
+    return chain
+
+# encode_block encodes a block in the format we send blocks to peers with. Returns the data and its content type
+def encode_block(block):
+    if wire_content_type == 'application/json':
+        return str(block), 'application/json'
+    return wire.encode_block(block, compress=(wire_content_type == wire.COMPRESSED_CONTENT_TYPE)), wire_content_type
+
+# post_block sends a block to a peer's /new_block_mined. data is the block encoded as content_type. If the peer
+# doesn't understand our binary format, the block is sent as JSON
+def post_block(peer_address, block, data, content_type):
+    if peer_address in json_only_peers:
+        data, content_type = str(block), 'application/json'
+    response = network.post(peer_address, '/new_block_mined', data=data, headers={'Content-Type': content_type})
+    if content_type != 'application/json' and response.status_code in (415, 500):
+        logger.info('%s does not support %s, using JSON' % (peer_address, content_type))
+        json_only_peers.add(peer_address)
+        response = network.post(peer_address, '/new_block_mined', data=str(block), headers={'Content-Type': 'application/json'})
+    return response
+
+# relay_block tells all known peers, except those in skip, about a block we've added. Peers get its hash and
+# download the block from us if they don't have it yet (see /inv). Peers we can't connect to are removed
+def relay_block(block, skip=()):
+    data, content_type = encode_block(block)
+    inventory = {'address': node_address, 'port': node_port, 'blocks': [{'height': block.height, 'hash': block.hash}]}
+
+    # send_to_peer announces the block to one peer, or sends the whole block if we can't announce it
+    def send_to_peer(peer_address):
+        if (node_address is not None or node_port is not None) and push_only_peers.get(peer_address) is None:
+            response = network.post(peer_address, '/inv', data=json.dumps(inventory), headers={'Content-Type': 'application/json'})
+            if response.status_code not in (404, 409):
+                return response
+            # 404: the peer doesn't know /inv, 409: the peer can't download blocks from us
+            logger.info('%s can not download announced blocks from us (%d), sending whole blocks' % (peer_address, response.status_code))
+            push_only_peers.put(peer_address, True)
+        return post_block(peer_address, block, data, content_type)
+
+    seen_blocks.put(block.hash, True)
+    results = network.fan_out([peer_address for peer_address in peers if peer_address not in skip], send_to_peer)
+    for peer_address, (response, error) in results.items():
+        if error is None:
+            logger.info('Block %d sent to %s' % (block.height, peer_address))
+        else:
+            check_peer_error(peer_address, error)
+
+# send_transactions sends a batch of queued transactions, a list of (transaction, skip), to our peers. Each peer gets
+# all the transactions it should have in one request per MAX_TRANSACTIONS_PER_REQUEST transactions
+def send_transactions(batch):
+    by_peer = {}
+    for tx, skip in batch:
+        for peer_address in peers:
+            if peer_address not in skip:
+                by_peer.setdefault(peer_address, []).append(str(tx))
+
+    # send_to_peer sends one peer its transactions
+    def send_to_peer(peer_address):
+        dumps = by_peer[peer_address]
+        for start in range(0, len(dumps), MAX_TRANSACTIONS_PER_REQUEST):
+            data = json.dumps(dumps[start:start + MAX_TRANSACTIONS_PER_REQUEST])
+            network.post(peer_address, '/relay_transactions', data=data, headers={'Content-Type': 'application/json'})
+
+    network.fan_out(list(by_peer), send_to_peer)
+
+# transactions that entered our pool are relayed to our peers in the background from this queue. It has its own
+# thread and sends the transactions waiting together, see send_transactions
+tx_relay_queue = TransactionRelayQueue(send_transactions)
+
+# relay_transactions queues transactions that entered our pool to be sent to all known peers except those in skip.
+# Peers add them to their pool, so they have them when they rebuild our compact blocks
+def relay_transactions(transactions, skip=()):
+    if len(transactions) > 0 and len(peers) > 0:
+        tx_relay_queue.put(transactions, skip)
+
+# transactions we create are relayed to our peers too
+node.relay_transactions = relay_transactions
+
+# blocks we've added are relayed to our peers in the background from this queue, see relay_block
+relay_queue = RelayQueue(relay_block)
+
+# accept_block adds a block we got from the network to our blockchain and queues it to be relayed to our peers,
+# except those in skip. It doesn't wait for the relay. If we don't have the block's parent, the block is kept as an
+# orphan and we ask source, the peer that sent it, for the parent. Returns True if the block was accepted
+def accept_block(block, skip=(), source=None):
+    # add_block checks the block and makes sure if can be added to our nodes blockchain (or a side branch)
+    last_block = node.chain.get_last_block() if node.chain.get_blockchain_size() > 0 else None
+    if not node.add_block(block):
+        if block.compute_hash() in node.orphans:
+            request_parent(source, block)
+        return False
+    logger.info('Block %d accepted from the network!' % block.height)
+    # propagate the new block to other known peers, along with the orphans that were waiting for it
+    relay_queue.put(block, skip)
+    for orphan in node.connect_orphans(block.hash):
+        relay_queue.put(orphan, skip)
+    # this flag signals the miner to move to the next block, if our last block changed
+    if node.chain.get_last_block() is not last_block:
+        node.new_block_received = True
+    return True
+
+# request_parent downloads the parent of an orphan block from source in the background, so the orphan can be added.
+# The parent is checked and accepted like any block, if it's an orphan too we ask for its parent in turn
+def request_parent(source, block):
+    # someone is already getting it for us
+    if seen_blocks.get(block.previous_hash):
+        return
+    if source is None:
+        logger.info('Block %d is an orphan and we do not know who sent it, waiting for its parent' % block.height)
+        return
+    seen_blocks.put(block.previous_hash, True)
+    inventory_executor.submit(fetch_announced_blocks, [source], [{'height': block.height - 1, 'hash': block.previous_hash}])
+
+# check_peer_error handles an error we got calling a peer. Slow peers are kept, they may answer next time, but
+# peers we can't connect to are removed
+def check_peer_error(peer_address, error):
+    if isinstance(error, (TimeoutError, requests.exceptions.ReadTimeout)):
+        logger.info('%s is too slow, skipped.' % peer_address)
+    else:
+        remove_peer(peer_address)
+        logger.info('Could not connect to %s! Peer removed.' % peer_address)
+
 # GET /start_mining instructs a node to start mining. This will return an error if the node is already mining.
 @app.route('/start_mining', methods=['GET'])
 def start_mining():    
@@ -87,17 +349,107 @@ def stop_mining():
 # GET /info gives basic information about this node. This endpoint returns the current blockchain size,
 # a list of this node's peers and the full blockchain for this node. You can use this to debug your node.
 # This endpoint is also used, when another peer wants to sync with this node's blockchain.
+# Use '?offset=N&limit=M' to get only M blocks starting from the N-th one (0 is the genesis block), and
+# '?stream=1' to get the blockchain as a stream: a line with the size and peers, then one line per block.
 @app.route('/info', methods=['GET'])
-def get_info():    
-    # create a list of blocks to jsonify
+def get_info(include_blocks=True):    
+    # the version of our blockchain we answer from
+    chain = node.chain
+    # create a list of blocks to send
     blocks = []
     # add all the blocks in our node's blockchain to this list
-    for block in node.blockchain.blocks:
-        blocks.append(str(block))
-    # return the information this endpoint is responsible for
-    return json.dumps({'chain_size': node.blockchain.get_blockchain_size(),                       
-                       'peers': peers,
-                       'blocks': blocks})
+    if include_blocks:
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = request.args.get('limit', type=int)
+        end = None if limit is None else offset + max(limit, 0)
+        blocks = chain.blocks[offset:end]
+    # stream the blocks one at a time, so we never hold the whole dump in memory
+    if request.args.get('stream', type=int):
+        return Response(stream_chain(peers, blocks, chain), content_type=NDJSON_CONTENT_TYPE)
+    # return the information this endpoint is responsible for, as JSON or in our binary format. It's the same
+    # until we get a new block (or peer), so it's cached
+    content_type = negotiate_content_type()
+    peer_list = list(peers)
+    key = ('info', tip_hash(chain), tuple(peer_list), include_blocks, request.args.get('offset'), request.args.get('limit'), content_type)
+    return cached_response(key, lambda: chain_body(peer_list, blocks, chain, content_type), content_type)
+
+# stream_chain yields our blockchain size and peers as a line of JSON, then a line for each block of chain
+def stream_chain(peer_list, blocks, chain):
+    yield json.dumps({'chain_size': chain.get_blockchain_size(), 'peers': list(peer_list)}) + '\n'
+    for block in blocks:
+        yield str(block) + '\n'
+
+# GET /tip returns the height and hash of our last block and the total work of our blockchain. It's all a peer needs
+# to know if we have something new for it, in a few hundred bytes. POST it with an 'address' field in the request
+# to also register as our peer, like /greet
+@app.route('/tip', methods=['GET', 'POST'])
+def get_tip():
+    if request.method == 'POST':
+        peer_address = (request.get_json(silent=True) or {}).get('address')
+        if not peer_address:
+            return 'Missing address', 400
+        add_peer(peer_address)
+
+    chain = node.chain
+    if chain.get_blockchain_size() == 0:
+        return json.dumps({'height': 0, 'hash': None, 'total_work': 0})
+    last_block = chain.get_last_block()
+    return json.dumps({'height': last_block.height, 'hash': last_block.hash, 'total_work': last_block.total_work})
+
+# GET /headers returns the headers of the blocks with heights from 'from' to 'to' (both included), see /blocks.
+# Headers have the same hash as their blocks but not their transactions, so they're small. At most
+# MAX_HEADERS_PER_REQUEST headers are returned
+@app.route('/headers', methods=['GET'])
+def get_headers():
+    chain = node.chain
+    start = request.args.get('from', 1, type=int)
+    end = request.args.get('to', chain.get_blockchain_size(), type=int)
+    end = min(end, start + MAX_HEADERS_PER_REQUEST - 1)
+    return json.dumps([block.header_fields() for block in chain.get_blocks(start, end)])
+
+# GET /block/<block_hash> returns the block with block_hash, from our blockchain or a side branch, as JSON or in
+# our binary format (see /info). Peers download blocks we've announced to them from here
+@app.route('/block/<block_hash>', methods=['GET'])
+def get_block(block_hash):
+    block = node.chain.get_block(block_hash)
+    if block is None:
+        return 'Block not found', 404
+    content_type = negotiate_content_type()
+    if content_type in wire.BINARY_CONTENT_TYPES:
+        return Response(wire.encode_block(block, compress=(content_type == wire.COMPRESSED_CONTENT_TYPE)), content_type=content_type)
+    return str(block)
+
+# GET /compact_block/<hash> returns the block with this hash as a compact block (see compact.py): its header and
+# a short ID for each transaction. Returns 404 if we don't have it
+@app.route('/compact_block/<block_hash>', methods=['GET'])
+def get_compact_block(block_hash):
+    block = node.chain.get_block(block_hash)
+    if block is None:
+        return 'Block not found', 404
+    return json.dumps(compact.encode_compact_block(block))
+
+# POST /block/<hash>/transactions returns some of the transactions of the block with this hash. It needs 'indexes',
+# the list of their positions in the block. Peers rebuilding a compact block ask for the ones they are missing
+@app.route('/block/<block_hash>/transactions', methods=['POST'])
+def get_block_transactions(block_hash):
+    block = node.chain.get_block(block_hash)
+    if block is None:
+        return 'Block not found', 404
+    indexes = (request.get_json(silent=True) or {}).get('indexes')
+    if not isinstance(indexes, list) or not all(isinstance(i, int) and 0 <= i < len(block.transactions) for i in indexes):
+        return 'Invalid indexes', 400
+    return json.dumps([str(block.transactions[i]) for i in indexes])
+
+# GET /blocks returns the blocks with heights from 'from' to 'to' (both included) along with our blockchain size.
+# 'from' defaults to the first block and 'to' to the last one. At most MAX_BLOCKS_PER_REQUEST blocks are returned,
+# ask again for the rest. Peers use this to sync only the blocks they are missing.
+@app.route('/blocks', methods=['GET'])
+def get_blocks():
+    chain = node.chain
+    start = request.args.get('from', 1, type=int)
+    end = request.args.get('to', chain.get_blockchain_size(), type=int)
+    end = min(end, start + MAX_BLOCKS_PER_REQUEST - 1)
+    return chain_response([], chain.get_blocks(start, end), chain)
 
 # POST /new_transaction creates a new transaction! You need to provide 'to' and 'amount'. It creates a new
 # transaction moving coins from this node's wallet to the address specified in 'to' (which may be invalid!)
@@ -119,27 +471,117 @@ def new_transaction():
         # if False is returned, something went wrong
         return 'Failed', 400
 
+# POST /new_transactions creates many transactions at once. It needs a list of transactions, each one with 'to' and
+# 'amount' like /new_transaction. The transactions are signed in parallel and added to the transaction pool together.
+# Returns a list with a result for each transaction: its 'hash' if it was added, or an 'error'
+@app.route('/new_transactions', methods=['POST'])
+def new_transactions():
+    req_data = request.get_json(silent=True)
+    if not isinstance(req_data, list):
+        return 'Invalid request: expected a list of transactions', 400
+    if len(req_data) > MAX_TRANSACTIONS_PER_REQUEST:
+        return 'Invalid request: at most %d transactions per request' % MAX_TRANSACTIONS_PER_REQUEST, 400
+
+    # check each transaction has all the fields we need and a positive amount, only the valid ones are created
+    results = [None] * len(req_data)
+    valid = []
+    for position, transaction in enumerate(req_data):
+        missing = [field for field in ('to', 'amount') if not isinstance(transaction, dict) or not transaction.get(field)]
+        if len(missing) > 0:
+            results[position] = {'error': 'missing field %s' % missing[0]}
+        elif not valid_amount(transaction['amount']):
+            results[position] = {'error': 'invalid amount %s' % json.dumps(transaction['amount'])}
+        else:
+            valid.append(position)
+
+    # call node's new_transactions function, which handles the transaction creation
+    for position, (tx_hash, error) in zip(valid, node.new_transactions([req_data[p] for p in valid])):
+        results[position] = {'hash': tx_hash} if error is None else {'error': error}
+    return json.dumps(results), 200
+
+# POST /relay_transactions is used to receive transactions from the network before they are mined. It needs a list
+# of JSON dumps of signed transactions, like the transactions of a block. Valid transactions we didn't have are added
+# to our transaction pool and relayed to our other peers. Returns the number of transactions added
+@app.route('/relay_transactions', methods=['POST'])
+def receive_transactions():
+    req_data = request.get_json(silent=True)
+    if not isinstance(req_data, list):
+        return 'Invalid request: expected a list of transactions', 400
+    if len(req_data) > MAX_TRANSACTIONS_PER_REQUEST:
+        return 'Invalid request: at most %d transactions per request' % MAX_TRANSACTIONS_PER_REQUEST, 400
+    try:
+        transactions = [load_transaction(tx_dump) for tx_dump in req_data]
+    except (ValueError, KeyError, TypeError):
+        return 'Invalid transaction', 400
+    # amounts we can't even compare with a balance
+    if any(isinstance(tx.amount, bool) or not isinstance(tx.amount, (int, float)) for tx in transactions):
+        return 'Invalid transaction: amounts should be numbers', 400
+    added = node.receive_transactions(transactions)
+    # don't send them back to the peer they came from, see /new_block_mined
+    relay_transactions(added, skip=[peer_address for peer_address in peers if request.remote_addr in peer_address])
+    return json.dumps({'added': len(added)}), 200
+
 # GET /balances returns a list of all addresses along with their balances, according to this node's version of the blockchain
 # balances do not include transactions not yet mined, it also has everyones balance because in a blockchain everybody knows what
-# everybody else owns!
+# everybody else owns! Add '?height=N' to get the balances right after block N was added.
 @app.route('/balances', methods=['GET'])
 def balances():    
-    # creating JSON in Python is pretty easy, nice!
-    return json.dumps(node.blockchain.balances)    
+    # all reads come from the same version of our blockchain
+    chain = node.chain
+    height = request.args.get('height', type=int)
+    if height is None:
+        # creating JSON in Python is pretty easy, nice! balances only change with our last block, so it's cached
+        return cached_response(('balances', tip_hash(chain)), lambda: json.dumps(chain.balances))
+    # check we have that block
+    if height < 0 or height > chain.get_blockchain_size():
+        return 'Invalid height %d' % height, 400
+    # we only keep the recent history of balances
+    if height < chain.history_start:
+        return 'Balances before block %d are not kept' % chain.history_start, 404
+    return cached_response(('balances', tip_hash(chain), height), lambda: json.dumps(chain.get_balances_at(height)))
 
 # GET /tx_pool returns list of transactions in the transaction pool. These transactions are created but not yet mined!
 # remember transactions in tx_pool are not yet executed by the blockchain. They will be final when they are mined in a block.
 @app.route('/tx_pool', methods=['GET'])
 def get_tx_pool():
-    # create a list of transactions, add transactions in the transaction pool to this
-    transactions = []
-    for tx in node.transaction_pool:
-        transactions.append(str(tx))    
-    # JSON dump the results to the user
-    return json.dumps(transactions)    
+    # build_tx_pool creates a list of transactions, add transactions in the transaction pool to this
+    def build_tx_pool():
+        transactions = []
+        for tx in node.transaction_pool:
+            transactions.append(str(tx))    
+        # JSON dump the results to the user
+        return json.dumps(transactions)    
+    # it's the same until a transaction enters or leaves the pool, so it's cached
+    return cached_response(('tx_pool', node.transaction_pool.version), build_tx_pool)
+
+# GET /tx/<tx_hash>/proof returns a Merkle proof that a transaction is in our blockchain. The proof has the header
+# of the block holding the transaction and the merkle branch of the transaction. Anyone can check the proof
+# with verify_merkle_proof without downloading the blocks!
+@app.route('/tx/<tx_hash>/proof', methods=['GET'])
+def get_tx_proof(tx_hash):
+    proof = node.chain.get_merkle_proof(tx_hash)
+    if proof is None:
+        return 'Transaction not found', 404
+    return json.dumps(proof)
+
+# GET /stats returns counters that show how hard our node is working: the hash rate of the miner and how
+# often our caches save us from repeating work
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return json.dumps({'hash_rate': node.mining_engine.hash_rate(),
+                       'signature_cache': signature_cache.stats(),
+                       'public_key_cache': public_key_cache.stats(),
+                       'seen_blocks': seen_blocks.stats(),
+                       'tx_pool': node.transaction_pool.stats(),
+                       'response_cache': response_cache.stats(),
+                       'relay_queue': relay_queue.stats(),
+                       'tx_relay_queue': tx_relay_queue.stats(),
+                       'orphans': node.orphans.stats(),
+                       'compact_blocks': compact_stats})
 
 # POST /greet greets another node who wants to sync with this node. It needs 'address' field in the request
-# to identify the peer. Retrurns get_info to the new node.
+# to identify the peer. Retrurns get_info to the new node. Set 'include_blocks' to false in the request to
+# get our info without the blocks.
 @app.route('/greet', methods=['POST'])
 def greet():    
     # Extract peer_address from the request
@@ -152,7 +594,7 @@ def greet():
     add_peer(peer_address)
 
     # return our node's info
-    return get_info()
+    return get_info(include_blocks=request.get_json().get('include_blocks', True))
 
 # POST /add_peer adds a new peer to our node and syncs with it. This endpoint adds the peer to the node's list
 # and calls consensus. Consensus checks the blockchain size on all peers (including the new one) and syncs with the 
@@ -170,121 +612,307 @@ def add_peer_and_consensus():
     # Call consensus to sync with this node (or the node with the longest chain in our peer list)
     return consensus()    
 
-# GET /consensus calls /greet on all known peers to find out about their blockchain and its size. 
-# It then syncs with the node with the longest blockchain.
+# GET /consensus calls /tip on all known peers to find out about their last block. It then syncs with the peer
+# with the heaviest blockchain (the one that took the most work to create): it downloads and checks the headers
+# we don't have first, and only then the blocks.
 @app.route('/consensus', methods=['GET'])
 def consensus():   
     logger.info('Running consensus ...') 
-    longest_chain = None
-    # current blockchain size on this node
-    current_size = node.blockchain.get_blockchain_size()
+    heaviest_peer = None
+    heaviest_tip = None
+    # total work of the blockchain on this node
+    current_work = node.chain.get_total_work()
+    # older peers without /tip only tell us their blockchain size, we sync with them if nobody is heavier
+    longest_peer = None
+    current_size = node.chain.get_blockchain_size()
 
     # these fields are repeated for all requests to peers
     data = {'address': request.host_url}
     headers = {'Content-Type': 'application/json'}
 
-    # for all known peers
-    for peer_address in peers:    
-        try:
-            # call peers /greet endpoint to find out about their blockchain
-            response = requests.post(peer_address + '/greet',
-                                data=json.dumps(data), headers=headers)
-        except:
+    # ask_tip calls a peer's /tip endpoint to find out about its blockchain. Older peers don't have it,
+    # we greet them instead, without asking for their blocks
+    def ask_tip(peer_address):
+        response = network.post(peer_address, '/tip', data=json.dumps(data), headers=headers)
+        if response.status_code == 404:
+            response = network.post(peer_address, '/greet', data=json.dumps(dict(data, include_blocks=False)), headers=headers)
+        return response
+
+    # ask all known peers at the same time, a slow peer doesn't hold back the others
+    for peer_address, (response, error) in network.fan_out(list(peers), ask_tip).items():
+        if error is not None:
             # if we can't connect to a peer, remove it from our list
-            peers.remove(peer_address)
-            logger.info('Could not connect to %s! Peer removed.' % peer_address)
+            check_peer_error(peer_address, error)
             # go to next peer
             continue
-
-        # if successful
-        if response.status_code == 200:
-            # check peers blockchain size
-            size = response.json()['chain_size']
-            # we're only interested in blockchains longer than our own.
-            # in blockchains, size DOES matter!
-            if size > current_size:
-                # keep this blockchain as the longest we've encountered so far
-                longest_chain = response.json()['blocks']            
-                current_size = size            
-            
-        else:        
+        if response.status_code != 200:
             logger.error('Invalid response received %d' % response.status_code)
-    
-    # if we found a blockchain longer than our own sync with it
-    if longest_chain:
-        node.sync_with_dump(longest_chain)
+            continue
+
+        try:
+            tip = response.json()
+            # we're only interested in blockchains heavier than our own
+            if 'total_work' in tip:
+                if tip['total_work'] > current_work:
+                    heaviest_peer = peer_address
+                    heaviest_tip = tip
+                    current_work = tip['total_work']
+            elif tip['chain_size'] > current_size:
+                longest_peer = peer_address
+                current_size = tip['chain_size']
+        except (ValueError, KeyError, TypeError):
+            logger.error('Invalid response received from %s' % peer_address)
+
+    try:
+        if heaviest_peer:
+            sync_with_tip(heaviest_peer, heaviest_tip)
+        elif longest_peer:
+            # download the whole blockchain of the older peer
+            chain_size, blockchain_dump = download_chain(longest_peer)
+            node.sync_with_dump(blockchain_dump, chain_size)
+    except requests.exceptions.RequestException:
+        logger.error('Could not sync with %s!' % (heaviest_peer or longest_peer))
     
     # done!
     return 'Done', 200
 
+# sync_with_tip syncs our blockchain with a peer whose last block is tip (as returned by its /tip endpoint),
+# downloading only the headers and blocks we don't have
+def sync_with_tip(peer_address, tip):
+    # fetch_headers downloads a range of headers from the peer
+    def fetch_headers(start, end):
+        response = network.get(peer_address, '/headers', params={'from': start, 'to': end})
+        if response.status_code != 200:
+            logger.error('Invalid response received %d' % response.status_code)
+            return []
+        headers = []
+        for header_data in response.json():
+            header = Block()
+            header.load_header(header_data)
+            headers.append(header)
+        return headers
+
+    # fetch_blocks downloads a range of blocks from the peer
+    def fetch_blocks(start, end):
+        # ask for our wire format, peers that don't know it answer in JSON
+        response = network.get(peer_address, '/blocks', params={'from': start, 'to': end},
+                               headers={'Accept': '%s, application/json;q=0.5' % wire_content_type})
+        if response.status_code != 200:
+            logger.error('Invalid response received %d' % response.status_code)
+            return []
+        return read_chain_response(response)['blocks']
+
+    # fetch_chain streams the peer's whole blockchain, when we have no blocks in common
+    def fetch_chain():
+        return download_chain(peer_address)
+
+    return node.sync_with_peer(fetch_headers, fetch_blocks, tip['height'], tip['total_work'], fetch_chain)
+
+# download_chain downloads a peer's whole blockchain from /info, for older peers that can't sync by headers and
+# for peers we have no blocks in common with. Returns its size and its block dumps. If the peer can stream, blocks
+# are returned as they arrive, so they can be checked one at a time without ever holding the whole dump in memory
+def download_chain(peer_address):
+    response = network.get(peer_address, '/info', params={'stream': 1}, stream=True)
+    if response.headers.get('Content-Type', '').startswith(NDJSON_CONTENT_TYPE):
+        lines = response.iter_lines()
+        chain_size = json.loads(next(lines))['chain_size']
+        return chain_size, (line.decode() for line in lines if line)
+    # the peer sent everything at once
+    chain = response.json()
+    return chain['chain_size'], chain['blocks']
+
 # POST /new_block_mined is used to receive new blocks from the network as they are mined. This endpoint
-# needs the JSON dump of the new block. An important thing to note here is the node checks the new block
+# needs the JSON dump of the new block, or the block in our binary format (see wire.py). An important thing to note here is the node checks the new block
 # closely to make sure it is valid for our current version of the chain. If the new block is valid it's also
 # propagated to our peer list so others know about this block. This is an important function to keep all nodes
 # in sync with each other's version of the blockchain. 
 @app.route('/new_block_mined', methods=['POST'])
 def new_block_mined():
-    # get the block from request
-    block_json = request.get_json()
+    # get the block from request, the content type tells us its format
     received_block = Block()
-    # load the data from the request to Block object
-    if received_block.load_from(block_json):
+    loaded = False
+    if request.mimetype in wire.BINARY_CONTENT_TYPES:
+        try:
+            received_block = wire.decode_block(request.get_data(), compressed=(request.mimetype == wire.COMPRESSED_CONTENT_TYPE))
+            loaded = True
+        except ValueError:
+            pass
+    elif request.mimetype == 'application/json':
+        # load the data from the request to Block object
+        loaded = received_block.load_from(request.get_json())
+    else:
+        return 'Unsupported content type', 415
+
+    if loaded:
         # this checks if this is a duplicate block we've received. assume we have 3 connected nodes
         # (A, B, C). if A mines a block and gives it to B and then B gives it to C, C doesn't know if
-        # A already has this block or not. This is a quick fix for this problem, we just discard blocks
-        # that we have received before! hash is a reliable way of ensuring the block is the same as the 
-        # received one
-        if node.blockchain.get_blockchain_size() > 0 and received_block.compute_hash() == node.blockchain.get_last_block().compute_hash():
+        # A already has this block or not. We just discard blocks that we have received before! hash is
+        # a reliable way of ensuring the block is the same as the received one
+        block_hash = received_block.compute_hash()
+        if seen_blocks.get(block_hash) or node.chain.knows_block(received_block.height, block_hash):
             return 'Accepted', 201
-        # add_block checks the block and makes sure if can be added to our nodes blockchain
-        if node.blockchain.add_block(received_block):
-            logger.info('Block %d accepted from the network!' % received_block.height)
-            # this flag signals the miner to move to the next block            
-            node.new_block_received = True
-            # propagate the new block to other known peers
-            for peer_address in peers:                        
-                # quick check not to send back a block to the originator
-                # as a side note, this is not a reliable way to identify sender,
-                # but doesn't introduce bugs as we can handle duplicate blocks (see comment a few lines above)                
-                if not request.remote_addr in peer_address:
-                    try:
-                        # call known peers /new_block_mined
-                        url = peer_address + '/new_block_mined'
-                        requests.post(url, data=request.data, headers=request.headers)    
-                        logger.info('Forwarded to %s' % peer_address)    
-                    except:                        
-                        # could not connect to peer! remove it
-                        peers.remove(peer_address)
-                        logger.info('Could not connect to %s! Peer removed.' % peer_address)
+        seen_blocks.put(block_hash, True)
+        # quick check not to send back a block to the originator. as a side note, this is not a reliable way
+        # to identify sender, but doesn't introduce bugs as we can handle duplicate blocks. The block is relayed
+        # in the background, we answer as soon as it's checked
+        skip = [peer_address for peer_address in peers if request.remote_addr in peer_address]
+        if accept_block(received_block, skip, source=skip[0] if len(skip) > 0 else None):
             return 'Accepted', 201
+        elif block_hash in node.orphans:
+            # we'll add it once we have its parent
+            return 'Accepted', 202
         else:            
             return 'Rejected', 400    
     else:
-        # could not load the block information from JSON
+        # could not load the block information from the request
         logger.info('Block %d rejected by load_from!' % received_block.height)
         return 'Rejected', 400 
     
+# POST /inv is used to announce new blocks by hash. It needs 'address', where the announcing peer can be reached, or
+# 'port', the port it listens on at the host the announcement comes from, and 'blocks', a list of blocks as 'height'
+# and 'hash'. Blocks we haven't seen yet are downloaded from the peer's /block endpoint in the background, checked,
+# and announced to our other peers in turn. Returns 409 if we couldn't download blocks from this peer recently, the
+# peer should send us whole blocks instead
+@app.route('/inv', methods=['POST'])
+def inventory():
+    req_data = request.get_json(silent=True) or {}
+    sources = announcement_sources(req_data.get('address'), req_data.get('port'))
+    if len(sources) == 0:
+        return 'Missing address', 400
+    if unreachable_announcers.get(announcer_id(req_data.get('address'), req_data.get('port'))) is not None:
+        return 'Can not download blocks from you, send whole blocks', 409
+    # keep only the blocks we haven't heard of. This is all we do for most announcements
+    wanted = []
+    for item in req_data.get('blocks', []):
+        if not seen_blocks.get(item['hash']):
+            seen_blocks.put(item['hash'], True)
+            wanted.append(item)
+    if len(wanted) > 0:
+        inventory_executor.submit(fetch_announced_blocks, sources, wanted,
+                                  announcer_id(req_data.get('address'), req_data.get('port')))
+    return 'Accepted', 202
+
+# announcer_id identifies the peer sending the announcement we're handling by its address, or its host and port
+def announcer_id(address, port):
+    if address:
+        return address.rstrip('/')
+    return '%s:%s' % (request.remote_addr, port)
+
+# announcement_sources returns the addresses we can download the blocks announced in the request we're handling
+# from: the address the peer gave us, the host the announcement came from with the port the peer gave us, and the
+# peers we know on that host
+def announcement_sources(address, port):
+    sources = []
+    if address:
+        sources.append(address.rstrip('/'))
+    if isinstance(port, int):
+        # IPv6 addresses go in brackets
+        host = '[%s]' % request.remote_addr if ':' in request.remote_addr else request.remote_addr
+        sources.append('http://%s:%d' % (host, port))
+    sources.extend(peer_address for peer_address in peers if request.remote_addr in peer_address)
+    # keep each address once, in order, with the ones that failed us before last
+    sources = list(OrderedDict.fromkeys(sources))
+    return sorted(sources, key=lambda source: unreachable_sources.get(source) is not None)
+
+# fetch_announced_blocks downloads the blocks announced by a peer that we don't have and adds them. Each block is
+# downloaded from the first of sources that has it. If we can't reach any of them, announcer is asked to send
+# whole blocks from now on (see /inv)
+def fetch_announced_blocks(sources, items, announcer=None):
+    for item in items:
+        if node.chain.knows_block(item['height'], item['hash']):
+            continue
+        block, source, unreachable = None, None, 0
+        for source in sources:
+            try:
+                block = fetch_block(source, item['hash'])
+            except requests.exceptions.RequestException as e:
+                unreachable += 1
+                unreachable_sources.put(source, True)
+                logger.error('Could not download block %d from %s: %s' % (item['height'], source, e))
+            if block is not None:
+                break
+        # forget blocks we couldn't get, so another peer announcing them (or sending them whole) can give them to us
+        if block is None:
+            seen_blocks.pop(item['hash'])
+            if announcer is not None and unreachable == len(sources):
+                logger.info('Can not reach %s, asking it to send whole blocks' % announcer)
+                unreachable_announcers.put(announcer, True)
+            continue
+        accept_block(block, skip=[source], source=source)
+
+# fetch_block downloads the block with block_hash from a peer. We ask for a compact block first and only download
+# the whole block if the peer doesn't serve compact blocks or we couldn't rebuild it. Returns None if the peer
+# doesn't have it or sent another block
+def fetch_block(peer_address, block_hash):
+    status_code = None
+    if peer_address not in full_block_peers:
+        response = network.get(peer_address, '/compact_block/' + block_hash)
+        status_code = response.status_code
+        if status_code == 200:
+            block = rebuild_compact_block(peer_address, block_hash, response)
+            if block is not None:
+                return block
+    block = fetch_full_block(peer_address, block_hash)
+    if block is not None:
+        compact_stats['full_blocks'] += 1
+        # the peer has the block, it just doesn't know compact blocks
+        if status_code == 404:
+            logger.info('%s does not support compact blocks, downloading whole blocks' % peer_address)
+            full_block_peers.add(peer_address)
+    return block
+
+# rebuild_compact_block rebuilds the block of a compact block we got from a peer in response, with the
+# transactions in our pool. The ones we don't have are downloaded from the peer. Returns None if we couldn't
+def rebuild_compact_block(peer_address, block_hash, response):
+    try:
+        compact_block = response.json()
+        if not compact.check_header(compact_block, block_hash):
+            return None
+        transactions, missing = compact.match_transactions(compact_block, block_hash, node.transaction_pool)
+        if len(missing) > 0:
+            response = network.post(peer_address, '/block/%s/transactions' % block_hash, json={'indexes': missing})
+            if response.status_code != 200 or len(response.json()) != len(missing):
+                return None
+            for position, tx_dump in zip(missing, response.json()):
+                transactions[position] = load_transaction(tx_dump)
+        block = compact.build_block(compact_block, transactions)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        block = None
+    if block is None or block.compute_hash() != block_hash:
+        logger.info('Could not rebuild compact block %s from %s' % (block_hash, peer_address))
+        return None
+    compact_stats['compact_blocks'] += 1
+    compact_stats['missing_transactions'] += len(missing)
+    return block
+
+# fetch_full_block downloads the block with block_hash from a peer's /block endpoint. Returns None if the peer
+# doesn't have it or sent another block
+def fetch_full_block(peer_address, block_hash):
+    # ask for our wire format, peers that don't know it answer in JSON
+    response = network.get(peer_address, '/block/' + block_hash,
+                           headers={'Accept': '%s, application/json;q=0.5' % wire_content_type})
+    if response.status_code != 200:
+        return None
+    content_type = response.headers.get('Content-Type', '').split(';')[0]
+    try:
+        if content_type in wire.BINARY_CONTENT_TYPES:
+            block = wire.decode_block(response.content, compressed=(content_type == wire.COMPRESSED_CONTENT_TYPE))
+        else:
+            block = Block()
+            block.load_from(response.json())
+    except (ValueError, KeyError):
+        return None
+    if block.compute_hash() != block_hash:
+        return None
+    return block
+
 # announce_new_block is called when our node finds (mines) a new block
-# it propagates that block to the network by calling /new_block_mined on
-# all known peers
+# it propagates that block to the network by announcing it to all known peers, in the background so the miner
+# can move on to the next block right away
 def announce_new_block(block):
     logger.info('Announcing block %d to %d peers ...' % (block.height, len(peers)))
-
-    # request data and headers are the same for every known peer
-    data = str(block)
-    headers = {'Content-Type': 'application/json'}
-    
-    # for all known peers
-    for peer_address in peers:        
-        try:
-            # call known peers /new_block_mined
-            url = peer_address + '/new_block_mined'
-            requests.post(url, data=data, headers=headers)    
-            logger.info('Announced to %s' % peer_address)    
-        except:
-            # could not connect to peer! remove it
-            peers.remove(peer_address)
-            logger.info('Could not connect to %s! Peer removed.' % peer_address)        
+    seen_blocks.put(block.hash, True)
+    relay_queue.put(block)
 
 # miner indefinitely tries to mine a new block. This is controlled by /start_mining and 
 # /stop_mining. A global variable called 'mining' controls whether the miner should be active or not.
@@ -294,7 +922,7 @@ def miner():
         # mine_block mines one block and returns True is successful
         if node.mine_block():
             # announce the new mined block to the network
-            announce_new_block(node.blockchain.get_last_block())
+            announce_new_block(node.chain.get_last_block())
         # reset the new_block_received flag when moving on to the next block
         node.new_block_received = False
     # mining flag is set to False
@@ -314,12 +942,40 @@ def add_peer(peer_address):
     else:
         logger.info("Peer already registered: %s", peer_address)        
 
+# remove_peer removes a peer from known peers list and closes our connection to it
+def remove_peer(peer_address):
+    if peer_address in peers:
+        peers.remove(peer_address)
+    network.close_session(peer_address)
+
 # this is our main
-# checks if the port number is supplied
-if len(sys.argv) != 2:
-    print('Usage: python app.py PORT_NUMBER')
-    raise SystemExit
-
-# runs Flask server. Binding to 0.0.0.0 makes the server accessible to the outside network, so you can try
-# connecting to other nodes! setting use_reloader to false ensures our Flask app does not restart if you change its code
-app.run(host='0.0.0.0', debug=True, port=sys.argv[1], use_reloader=False)
+if __name__ == '__main__':
+    # checks if the port number is supplied, the number of mining processes is optional
+    parser = argparse.ArgumentParser(usage='python app.py PORT_NUMBER [--workers N] [--key-cache-size N] [--data-dir DIR] [--address URL] [--wire-format FORMAT]')
+    parser.add_argument('port', type=int, help='port number to listen on')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes used for mining')
+    parser.add_argument('--key-cache-size', type=int, default=PUBLIC_KEY_CACHE_SIZE,
+                        help='number of parsed public keys kept in memory')
+    parser.add_argument('--data-dir', help='directory to keep our blocks in, so they survive a restart')
+    parser.add_argument('--address', help='address peers reach this node at (default: PORT at the host peers see us connect from)')
+    parser.add_argument('--wire-format', choices=sorted(WIRE_FORMATS), default='binary',
+                        help='format used to send blocks to peers')
+    args = parser.parse_args()
+
+    # peers download the blocks we announce from this address, or from our port at the host we connect from
+    node_address = args.address
+    node_port = args.port
+    # set the format we send blocks in
+    wire_content_type = WIRE_FORMATS[args.wire_format]
+
+    # choose how many processes our miner uses
+    node.set_mining_workers(args.workers)
+    # and how many public keys we remember
+    public_key_cache.resize(args.key_cache_size)
+    # load our blocks from disk
+    if args.data_dir:
+        node.open_store(args.data_dir)
+
+    # runs Flask server. Binding to 0.0.0.0 makes the server accessible to the outside network, so you can try
+    # connecting to other nodes! setting use_reloader to false ensures our Flask app does not restart if you change its code
+    app.run(host='0.0.0.0', debug=True, port=args.port, use_reloader=False)
@@ -5,8 +5,15 @@ from hashlib import sha256
 import json
 import time
 import logging
+import os
+import itertools
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 from Crypto.PublicKey import RSA
 import base64
+from cache import LRUCache
+from workers import worker_context, map_batches
 
 # get logger to print out stuff
 logger = logging.getLogger()
@@ -22,21 +29,303 @@ BLOCK_TIME_IN_SECONDS = 5
 # 10 coins will be awarded to the miner who solves a block! (finds its nonce)
 BLOCK_REWARD = 10
 
-# the Transaction cass defines a transaction
+# checking a signature is slow (2048 bit RSA!), so big blocks have their signatures checked on a pool of
+# processes. Signatures are sent to the pool in batches of SIGNATURE_BATCH_SIZE
+SIGNATURE_BATCH_SIZE = 64
+# with fewer transactions than this, sending them to other processes costs more than it saves
+PARALLEL_VERIFY_THRESHOLD = 128
+# number of processes checking signatures
+VERIFY_WORKERS = os.cpu_count() or 1
+# load_from checks the signatures of this many blocks at once
+LOAD_BATCH_BLOCKS = 100
+
+# every BALANCE_SNAPSHOT_INTERVAL blocks the blockchain keeps a copy of all balances. Together with the balance
+# changes of each block, this lets us find the balances at any height by replaying at most half an interval
+BALANCE_SNAPSHOT_INTERVAL = 100
+# only the last MAX_BALANCE_SNAPSHOTS copies are kept, along with the balance changes since the oldest one. Older
+# balances can't be looked up and older blocks can't be undone, so this should cover well over MAX_FORK_DEPTH blocks
+MAX_BALANCE_SNAPSHOTS = 10
+
+# we keep blocks of competing branches (side branches) up to MAX_FORK_DEPTH blocks below our last block, so we
+# can switch to a branch if it becomes heavier than ours. At most MAX_SIDE_BLOCKS of them are kept
+MAX_FORK_DEPTH = 100
+MAX_SIDE_BLOCKS = 1000
+
+# blocks arriving before their parent (orphans) are kept until the parent arrives. At most MAX_ORPHAN_BLOCKS of them
+# are kept, and only if they are at most that many blocks above our last block; further ahead we'd better sync
+MAX_ORPHAN_BLOCKS = 100
+
+# the pool of processes checking signatures, created the first time we need it
+_verify_pool = None
+
+# we remember this many (tx hash, signature) pairs we have already verified. The same transaction is checked
+# when it enters our transaction pool, when its block is accepted and every time we sync the blockchain,
+# the cache saves us from doing the RSA work again each time
+SIGNATURE_CACHE_SIZE = 100000
+signature_cache = LRUCache(SIGNATURE_CACHE_SIZE)
+
+# parsing a public key is slow too, and most transactions come from a few addresses. We keep the parsed keys
+# of the PUBLIC_KEY_CACHE_SIZE most recently used addresses (resize public_key_cache to change it)
+PUBLIC_KEY_CACHE_SIZE = 1024
+public_key_cache = LRUCache(PUBLIC_KEY_CACHE_SIZE)
+
+# canonical_dumps encodes blocks and transactions as JSON. Hashes are computed over its output, so every node must
+# produce exactly the same bytes: json.dumps with its default settings. Use set_json_codec to plug in a faster
+# encoder, it's only used if it gives the same output
+canonical_dumps = json.JSONEncoder().encode
+
+# CODEC_SAMPLES are the values a new JSON codec should encode exactly like json.dumps: the fields of our
+# transactions and blocks, with the odd characters, numbers and nesting they may contain
+CODEC_SAMPLES = [
+    {'from': 'COINBASE', 'to': 'MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEA+/b=', 'amount': 10},
+    {'from': 'a/b+c=', 'to': 'caf\u00e9 "quoted" \\ \n\t\u2603', 'amount': 1.5, 'signature': 2**2048 - 1},
+    {'height': 1, 'difficulty': -3, 'nonce': 0, 'previous_hash': '', 'transactions': [], 'timestamp': 1700000000.123456},
+    {'height': 2**40, 'difficulty': 10, 'nonce': 123456789, 'previous_hash': '0' * 64, 'merkle_root': 'f' * 64,
+     'transactions': ['{"from": "x"}', ''], 'timestamp': 1e16},
+    {'amount': 1e-7, 'big': 12345678901234567890.0, 'flag': True, 'none': None, 'nested': [[1, 2.0], {'k': 'v'}]},
+]
+
+# set_json_codec replaces canonical_dumps with dumps, a function encoding a value as a JSON string (or UTF-8 bytes).
+# It's checked on CODEC_SAMPLES first: a codec that doesn't match json.dumps byte for byte would give our blocks
+# different hashes than other nodes do, so it's rejected. Returns True if the codec is used
+def set_json_codec(dumps):
+    global canonical_dumps
+    # bytes are fine, as long as they decode to the same string
+    def encode(value):
+        data = dumps(value)
+        return data.decode() if isinstance(data, bytes) else data
+    try:
+        matches = all(encode(sample) == json.dumps(sample) for sample in CODEC_SAMPLES)
+    except Exception as e:
+        logger.error('JSON codec %r failed: %s' % (dumps, e))
+        return False
+    if not matches:
+        logger.error('JSON codec %r does not match json.dumps, keeping the current one' % dumps)
+        return False
+    canonical_dumps = encode
+    return True
+
+# import_public_key returns the RSA key object for an address (a base64 DER public key)
+def import_public_key(address):
+    key = public_key_cache.get(address)
+    if key is None:
+        key = RSA.importKey(base64.b64decode(address))
+        public_key_cache.put(address, key)
+    return key
+
+# check_signature checks signature is a valid signature of tx_hash by signer. signer is a base64 DER public key
+def check_signature(signer, tx_hash, signature):
+    # load the key from the signer field
+    key = import_public_key(signer)
+    # verify transaction using RSA
+    return key.verify(tx_hash.encode(), [signature])
+
+# _verify_batch checks a batch of (signer, tx_hash, signature) tuples and returns a list of results.
+# It runs on the processes of the verification pool
+def _verify_batch(batch):
+    results = []
+    for signer, tx_hash, signature in batch:
+        try:
+            results.append(check_signature(signer, tx_hash, signature))
+        except Exception:
+            # a key we can't even load is not a valid signature
+            results.append(False)
+    return results
+
+# _init_verifier runs once in every process of the verification pool. A forked process inherits our public key
+# cache along with its lock, which another of our threads may have been holding at the time and would never
+# release in the new process. Each process gets an empty cache of its own instead
+def _init_verifier():
+    global public_key_cache
+    public_key_cache = LRUCache(public_key_cache.maxsize)
+
+# get_verify_pool returns the pool of processes used to check signatures
+def get_verify_pool():
+    global _verify_pool
+    if _verify_pool is None:
+        # _init_verifier takes care of the only lock our workers use, so they can be forked
+        _verify_pool = ProcessPoolExecutor(VERIFY_WORKERS, mp_context=worker_context(), initializer=_init_verifier)
+    return _verify_pool
+
+# find_invalid_signature checks the signatures of a list of transactions and returns the position of the
+# first one with an invalid signature, or None if they are all fine. Long lists are checked in parallel
+def find_invalid_signature(transactions):
+    # skip the signatures we have verified before
+    results = [signature_cache.get((tx.compute_hash(), tx.signature)) for tx in transactions]
+    unchecked = [position for position, ok in enumerate(results) if ok is None]
+
+    items = [(transactions[p].signer(), transactions[p].compute_hash(), transactions[p].signature) for p in unchecked]
+    checked = map_batches(_verify_batch, items, SIGNATURE_BATCH_SIZE, PARALLEL_VERIFY_THRESHOLD, VERIFY_WORKERS,
+                          get_verify_pool)
+
+    for position, ok in zip(unchecked, checked):
+        results[position] = ok
+        # remember the good ones
+        if ok:
+            signature_cache.put((transactions[position].compute_hash(), transactions[position].signature), True)
+
+    for position, ok in enumerate(results):
+        if not ok:
+            return position
+    return None
+
+# merkle_parent_level hashes a level of a Merkle tree into the level above it. Each hash in the new level
+# is the hash of a pair of hashes from the level below
+def merkle_parent_level(level):
+    parents = [sha256((level[i] + level[i + 1]).encode()).hexdigest() for i in range(0, len(level) - 1, 2)]
+    # if the level has an odd number of hashes the last one moves up as it is, we don't pair it
+    # with itself, otherwise [a, b, c] and [a, b, c, c] would have the same root
+    if len(level) % 2 == 1:
+        parents.append(level[-1])
+    return parents
+
+# compute_merkle_root computes the root of a Merkle tree over a list of hashes. Each level of the tree hashes
+# pairs of hashes from the level below, until one hash is left: the root. Changing any transaction changes the
+# root, so a block header only needs the root to commit to all of its transactions
+def compute_merkle_root(hashes):
+    # a block without transactions has an all zero root
+    if len(hashes) == 0:
+        return '0' * 64
+    level = list(hashes)
+    while len(level) > 1:
+        level = merkle_parent_level(level)
+    return level[0]
+
+# compute_merkle_branch returns the hashes needed to recompute the merkle root starting from the hash at
+# position index. Each step of the branch has the sibling 'hash' and its 'position' ('left' or 'right')
+def compute_merkle_branch(hashes, index):
+    branch = []
+    level = list(hashes)
+    while len(level) > 1:
+        if index % 2 == 1:
+            branch.append({'hash': level[index - 1], 'position': 'left'})
+        elif index + 1 < len(level):
+            branch.append({'hash': level[index + 1], 'position': 'right'})
+        # else, our hash is the odd one out and moves up without a sibling
+        level = merkle_parent_level(level)
+        index //= 2
+    return branch
+
+# verify_merkle_proof checks a proof returned by GET /tx/<hash>/proof. It checks the header hashes to the
+# block hash, the block hash solves the block's difficulty and the branch leads from the transaction hash to
+# the header's merkle root. It only needs the header and a few hashes, not the whole block! Keep in mind you
+# still need to check block_hash is part of the chain you trust
+def verify_merkle_proof(tx_hash, proof):
+    header = proof['header']
+    # the header should hash to the block hash
+    if sha256(json.dumps(header).encode()).hexdigest() != proof['block_hash']:
+        return False
+    # the block hash should be smaller than the target
+    if not int(proof['block_hash'], 16) < (2**256 - 1) >> header['difficulty']:
+        return False
+    # climb up the tree, hashing with the sibling on each level
+    current = tx_hash
+    for step in proof['branch']:
+        if step['position'] == 'left':
+            current = sha256((step['hash'] + current).encode()).hexdigest()
+        else:
+            current = sha256((current + step['hash']).encode()).hexdigest()
+    # we should end up at the merkle root
+    return current == header['merkle_root']
+
+# next_difficulty returns the difficulty of the block after previous, the list of the last (up to) two blocks of a
+# blockchain. It checks the time it took to create the last two blocks and compares it to BLOCK_TIME_IN_SECONDS
+def next_difficulty(previous):
+    # if we have more than 1 block
+    if len(previous) > 1:
+        # calculate the time difference between last 2 blocks
+        block_time_diff = previous[-1].timestamp - previous[-2].timestamp
+        # tweak difficulty based on time
+        if block_time_diff < BLOCK_TIME_IN_SECONDS:
+            # increase difficulty if the last two blocks are mined fast
+            return previous[-1].difficulty + 1
+        else:
+            # decrease difficulty if the last two blocks are mined slow
+            return previous[-1].difficulty - 1
+    else:
+        # block 1 is mined with START_DIFFICULTY
+        return START_DIFFICULTY
+
+# check_headers checks a list of consecutive block headers (blocks loaded with load_header) coming after previous,
+# the last (up to) two blocks before them. Headers should be chained by hashes, have a valid proof of work and the
+# right difficulty. This is everything we can check without the transactions. Sets hash and total_work on each
+# header and returns True if they are all valid
+def check_headers(headers, previous):
+    previous = list(previous)
+    for header in headers:
+        header.hash = header.compute_hash()
+        if len(previous) == 0:
+            # the genesis block has nothing to be chained to
+            if header.height != 1:
+                logger.error('Header %d is invalid: expected height is 1' % header.height)
+                return False
+            header.total_work = 2 ** header.difficulty
+        else:
+            if header.height != previous[-1].height + 1 or header.previous_hash != previous[-1].hash:
+                logger.error('Header %d is invalid: not chained to block %d' % (header.height, previous[-1].height))
+                return False
+            if not header.hash < header.difficulty_to_target():
+                logger.error('Header %d is invalid: hash is %s should be smaller than %s' % (header.height, header.hash, header.difficulty_to_target()))
+                return False
+            if header.difficulty != next_difficulty(previous):
+                logger.error('Header %d is invalid: difficulty is %d should be %d' % (header.height, header.difficulty, next_difficulty(previous)))
+                return False
+            header.total_work = previous[-1].total_work + 2 ** header.difficulty
+        previous = previous[-1:] + [header]
+    return True
+
+# set_balances sets the balance of each address in values in balances. Addresses set to None are removed
+def set_balances(balances, values):
+    for address, balance in values.items():
+        if balance is None:
+            balances.pop(address, None)
+        else:
+            balances[address] = balance
+
+# the Transaction cass defines a transaction. Once it's signed, a transaction is sealed: its JSON dump is kept and
+# its fields can't change anymore, so we don't encode it again every time it's hashed, stored or sent
 class Transaction:
+    # FIELDS are the attributes that are part of the transaction, they can't be set once it's sealed
+    FIELDS = ('from_pubkey', 'to_pubkey', 'amount', 'signature')
+
     # each transaction has 'from', 'to' and 'amount'
     # keep in mind addresses ('from' and 'to') are public keys of nodes
     def __init__(self, from_pubkey, to_pubkey, amount):
+        # the JSON dump of a sealed transaction, None until it's sealed
+        self._encoded = None
         self.from_pubkey = from_pubkey
         self.to_pubkey = to_pubkey
         self.amount = amount    
         # blank signature when creating a transaction
         self.signature = ''        
+        # the hash is computed once and cached. The hash doesn't cover the signature, the other fields
+        # should not change after the transaction is created
+        self._hash = None
+
+    # __setattr__ refuses to change the fields of a sealed transaction, its dump and hash would be wrong
+    def __setattr__(self, name, value):
+        if name in Transaction.FIELDS and self.__dict__.get('_encoded') is not None:
+            raise AttributeError('transaction %s is sealed, can not set %s' % (self._hash, name))
+        object.__setattr__(self, name, value)
+
+    # seal keeps the JSON dump and the hash of this transaction and makes it read only. Returns the transaction
+    def seal(self):
+        if self._encoded is None:
+            self.compute_hash()
+            self._encoded = self.encode()
+        return self
     
     # returns a string representation of this class
     def __str__(self):
+        # a sealed transaction already has it
+        if self._encoded is not None:
+            return self._encoded
+        return self.encode()
+
+    # encode returns the JSON dump of this transaction, see __str__
+    def encode(self):
         # use JSON dump on all 4 fields
-        return json.dumps({
+        return canonical_dumps({
             'from': self.from_pubkey,
             'to': self.to_pubkey,
             'amount': self.amount,
@@ -44,33 +333,58 @@ class Transaction:
     
     # returns a hash for this Transaction object
     def compute_hash(self):          
+        # we've already computed it!
+        if self._hash is not None:
+            return self._hash
         # exclude signature, as we sign the tx hash
-        tx_str = json.dumps({
+        tx_str = canonical_dumps({
             'from': self.from_pubkey,
             'to': self.to_pubkey,
             'amount': self.amount})
-        # use sha256 for hashing, return a hexdigest string
-        return sha256(tx_str.encode()).hexdigest()
+        # use sha256 for hashing, keep the hexdigest string for next time
+        self._hash = sha256(tx_str.encode()).hexdigest()
+        return self._hash
     
+    # signer returns the public key that should have signed this transaction
+    def signer(self):
+        # COINBASE transactions are different, pick 'to' field as signer
+        if self.from_pubkey == 'COINBASE':
+            return self.to_pubkey
+        # otherwise use the public key from 'from' field
+        return self.from_pubkey
+
     # verify_signature verifies the transaction signature
     # its worth mentioning that you don't need to be owner (from) of this transaction
     # to be able to verify it's signature.
     def verify_signature(self):        
-        # use the public key from 'from' field
-        signer = self.from_pubkey
-        # COINBASE transactions are different, pick 'to' field as signer
-        if self.from_pubkey == 'COINBASE':
-            signer = self.to_pubkey
-        
-        # load the key from the signer field
-        key = RSA.importKey(base64.b64decode(signer))        
-        # verify transaction using RSA
-        return key.verify(self.compute_hash().encode(), [self.signature])
+        # did we verify this signature before?
+        key = (self.compute_hash(), self.signature)
+        if signature_cache.get(key):
+            return True
+        if not check_signature(self.signer(), self.compute_hash(), self.signature):
+            return False
+        # only good signatures are remembered
+        signature_cache.put(key, True)
+        return True
     
-# the Block class defines a block which is a grouping of transactions chained to other blocks using hashes
+# load_transaction recreates a transaction from its JSON dump (see Transaction.__str__) and seals it
+def load_transaction(tx_dump):
+    tx_data = json.loads(tx_dump)
+    tx = Transaction(from_pubkey=tx_data['from'], to_pubkey=tx_data['to'], amount=tx_data['amount'])
+    tx.signature = tx_data['signature']
+    return tx.seal()
+
+# the Block class defines a block which is a grouping of transactions chained to other blocks using hashes. Blocks
+# are sealed when they are loaded or added to a blockchain: their JSON dump and hash are kept and they become read only
 class Block:
+    # FIELDS are the attributes that are part of the block, they can't be set once it's sealed
+    FIELDS = ('height', 'difficulty', 'previous_hash', 'transactions', 'timestamp', 'nonce')
+
     # empty constructor
     def __init__(self):        
+        # the JSON dump and hash of a sealed block, None until it's sealed
+        self._encoded = None
+        self._hash = None
         # height is the index of the block in blockchain
         self.height = -1
         # difficulty defines how hard it is to create this block.
@@ -84,6 +398,8 @@ class Block:
         self.transactions = []
         self.timestamp = time.time()
         self.nonce = 0
+        # the merkle root of transactions, computed once when the block is first hashed
+        self._merkle_root = None
 
     # fill_block fills the block with provided values
     def fill_block(self, height, difficulty, previous_hash, transactions, timestamp):
@@ -94,14 +410,47 @@ class Block:
         self.timestamp = timestamp
         # set nonce to zero. we have to find the correct value in mining        
         self.nonce = 0
+        # transactions changed, forget the old merkle root
+        self._merkle_root = None
+
+    # set_transactions replaces the transactions of this block, for example to add new ones while mining it
+    def set_transactions(self, transactions):
+        self.transactions = transactions
+        # transactions changed, forget the old merkle root
+        self._merkle_root = None
+
+    # __setattr__ refuses to change the fields of a sealed block, its dump and hash would be wrong
+    def __setattr__(self, name, value):
+        if name in Block.FIELDS and self.__dict__.get('_encoded') is not None:
+            raise AttributeError('block %s is sealed, can not set %s' % (self._hash, name))
+        object.__setattr__(self, name, value)
+
+    # seal seals the transactions of this block, keeps its JSON dump and hash and makes it read only.
+    # Returns the block
+    def seal(self):
+        if self._encoded is None:
+            for tx in self.transactions:
+                tx.seal()
+            # a tuple, so no transaction can be added or removed either
+            self.transactions = tuple(self.transactions)
+            self._hash = self.compute_hash()
+            self._encoded = self.encode()
+        return self
 
     # returns a string representation of this Block
     def __str__(self):        
+        # a sealed block already has it
+        if self._encoded is not None:
+            return self._encoded
+        return self.encode()
+
+    # encode returns the JSON dump of this block, see __str__
+    def encode(self):
         # stringify all the transactions in this block
         tx_dump = [str(tx) for tx in self.transactions]
         
         # use JSON as stringify function
-        return json.dumps({
+        return canonical_dumps({
             'height': self.height,
             'difficulty': self.difficulty,
             'nonce': self.nonce,
@@ -109,30 +458,63 @@ class Block:
             'transactions': tx_dump,
             'timestamp': self.timestamp})        
     
-    # compute_hash computes hash of this block. Hashes are fingerprints of data!
-    def compute_hash(self):        
-        # hash all the transactions in a block and put them in a list
-        tx_hashes = [tx.compute_hash() for tx in self.transactions]
-        
-        # JSON representation of block and hash of all its transactions
-        block = json.dumps({
+    # merkle_root returns the root of the Merkle tree over this block's transaction hashes. The root is cached,
+    # so transactions should not be changed after the block is hashed (use fill_block or load_from instead)
+    def merkle_root(self):
+        if self._merkle_root is None:
+            self._merkle_root = compute_merkle_root([tx.compute_hash() for tx in self.transactions])
+        return self._merkle_root
+
+    # header_fields returns the fields of this block that are hashed. The order of the fields matters,
+    # the mining engine relies on it to produce the same bytes as compute_hash
+    def header_fields(self):
+        # the block commits to its transactions through the merkle root, so the header has the same
+        # size no matter how many transactions the block holds
+        return {
             'height': self.height,
             'difficulty': self.difficulty,
             'nonce': self.nonce,
             'previous_hash': self.previous_hash,
-            'transactions': ','.join(tx_hashes),
-            'timestamp': self.timestamp})
+            'merkle_root': self.merkle_root(),
+            'timestamp': self.timestamp}
+
+    # compute_hash computes hash of this block. Hashes are fingerprints of data!
+    def compute_hash(self):        
+        # a sealed block already has it
+        if self._hash is not None:
+            return self._hash
+        # JSON representation of block and hash of all its transactions
+        block = canonical_dumps(self.header_fields())
         # hash all the block data and transactions defined aboves
         return sha256(block.encode()).hexdigest()
     
+    # target returns the target as an integer. A block is solved when its hash, read as a number,
+    # is smaller than the target
+    def target(self):
+        # (2**256 - 1) is 'fff...f' (256 bits)
+        # shifting this value right creates zeroes on the left side ('difficulty' number of times!)
+        return (2**256 - 1) >> self.difficulty
+
     # difficulty_to_target converts difficulty to target. Target is the value that 
     # defines what the maximum value for an acceptable hash is based on difficulty
     # if difficulty increases, target decreases and vice versa    
     def difficulty_to_target(self):        
-        # (2**256 - 1) is 'fff...f' (256 bits)
-        # shifting this value right creates zeroes on the left side ('difficulty' number of times!)
-        return format((2**256 - 1) >> self.difficulty, '064x')        
+        # format the target as a 64 characters hex string, just like our hashes
+        return format(self.target(), '064x')        
     
+    # load_header recreates a block from its header (see header_fields) without its transactions. It has the same
+    # hash as the full block, so a peer's blocks can be checked before we download their transactions
+    def load_header(self, header):
+        self.height = header['height']
+        self.difficulty = header['difficulty']
+        self.nonce = header['nonce']
+        self.previous_hash = header['previous_hash']
+        self.transactions = []
+        self.timestamp = header['timestamp']
+        # we don't have the transactions, so we take the merkle root as it is
+        self._merkle_root = header['merkle_root']
+        return True
+
     # load_from accpets a JSON dump of a block and recreates it as an object
     def load_from(self, block_data):        
         # contains transaction list for this block
@@ -147,8 +529,8 @@ class Block:
                 amount=tx_data['amount'],
             )
             tx.signature = tx_data['signature']            
-            # add it to the transaction list defined above
-            tx_list.append(tx)            
+            # add it to the transaction list defined above, it won't change anymore
+            tx_list.append(tx.seal())            
         
         # set block properties
         self.height = block_data['height']
@@ -157,10 +539,97 @@ class Block:
         self.transactions = tx_list
         self.timestamp = block_data['timestamp']
         self.nonce = block_data['nonce']	        
+        # transactions changed, forget the old merkle root
+        self._merkle_root = None
+        # the block is complete, it won't change anymore
+        self.seal()
         
         # we've processed successfully!
         return True
 
+# the OrphanPool class holds blocks whose parent we don't have yet, keyed by the hash of that parent. When it's full
+# the orphans that arrived first are dropped
+class OrphanPool:
+    # constructor
+    def __init__(self, maxsize=MAX_ORPHAN_BLOCKS):
+        self.maxsize = maxsize
+        # all orphans by hash, in the order they arrived
+        self.blocks = OrderedDict()
+        # the orphans waiting for each parent, by parent hash
+        self.by_previous_hash = {}
+
+    # returns the number of orphans in the pool
+    def __len__(self):
+        return len(self.blocks)
+
+    # checks if the block with block_hash is in the pool
+    def __contains__(self, block_hash):
+        return block_hash in self.blocks
+
+    # add keeps an orphan block until its parent arrives. Returns False if we have it already
+    def add(self, block):
+        block_hash = block.compute_hash()
+        if block_hash in self.blocks:
+            return False
+        self.blocks[block_hash] = block
+        self.by_previous_hash.setdefault(block.previous_hash, {})[block_hash] = block
+        while len(self.blocks) > self.maxsize:
+            self.remove(next(iter(self.blocks)))
+        return True
+
+    # remove removes the orphan with block_hash from the pool, if it's there
+    def remove(self, block_hash):
+        block = self.blocks.pop(block_hash, None)
+        if block is None:
+            return
+        children = self.by_previous_hash[block.previous_hash]
+        del children[block_hash]
+        if len(children) == 0:
+            del self.by_previous_hash[block.previous_hash]
+
+    # pop_children removes and returns the orphans waiting for the block with previous_hash
+    def pop_children(self, previous_hash):
+        children = list(self.by_previous_hash.get(previous_hash, {}).values())
+        for block in children:
+            self.remove(block.compute_hash())
+        return children
+
+    # prune drops orphans at or below height, their parents would be too deep in our blockchain to follow them
+    def prune(self, height):
+        for block_hash, block in list(self.blocks.items()):
+            if block.height <= height:
+                self.remove(block_hash)
+
+    # stats returns the number of orphans in the pool along with our limit
+    def stats(self):
+        return {'size': len(self.blocks), 'maxsize': self.maxsize}
+
+# the SharedList class is a read-only view of the first length items of a list. Items may be added to the list
+# afterwards, the view doesn't see them. Indexes, slices, len and iteration work like on a list
+class SharedList:
+    # constructor
+    def __init__(self, items, length):
+        self.items = items
+        self.length = length
+
+    # __len__ returns the number of items in the view
+    def __len__(self):
+        return self.length
+
+    # __getitem__ returns an item of the view, or a list for a slice
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.items[slice(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('list index out of range')
+        return self.items[index]
+
+    # __iter__ goes through the items of the view in order
+    def __iter__(self):
+        return itertools.islice(self.items, self.length)
+
 # the Blockchain class defines a blockchain as an object
 class Blockchain:    
 
@@ -170,6 +639,27 @@ class Blockchain:
         self.blocks = []
         # its worth mentioning that list of balances is calculated based on list of blocks!
         self.balances = {}
+        # maps a transaction hash to the height of its block and its position in the block
+        self.tx_index = {}
+        # maps a block hash to the height of the block, for blocks in our blockchain
+        self.block_index = {}
+        # the balance changes of each block: for each address the block changed, its balance before and after
+        # the block (None if the address had no balance). This lets us undo blocks and look up old balances
+        self.balance_changes = []
+        # copies of the balances every BALANCE_SNAPSHOT_INTERVAL blocks, by height
+        self.balance_snapshots = {}
+        # balances before this height aren't kept anymore, the balance changes of blocks up to it are None
+        self.history_start = 0
+        # True once snapshot shares our blocks and balance changes with readers. They only see the items that were
+        # there at the time, so we can keep adding items, but we copy the lists before removing any
+        self.shared = False
+        # blocks of recent side branches (not part of our blockchain), by hash
+        self.side_blocks = {}
+        # the block store on disk our blocks are written to, if we have one
+        self.store = None
+        # the transaction pool of our node, if we have one. Transactions leave it when their block is added and
+        # come back when their block is removed
+        self.mempool = None
     
     # create_genesis_block creates the first blockchain block! this is a special block as there is none before
     def create_genesis_block(self):
@@ -191,14 +681,147 @@ class Blockchain:
     def get_last_block(self):        
         return self.blocks[-1]
     
-    # add_block adds a block to our blockchain. This function checks everything to make sure
-    # the added block is correct and sound
-    def add_block(self, block):                  
-        # set the blocks hash
-        block.hash = block.compute_hash()        
-        
+    # get_total_work returns the total work of our blockchain. Each block adds 2 ** difficulty, the number of
+    # hashes it takes on average to mine it. The heaviest branch is the one that took the most work to create
+    def get_total_work(self):
+        if len(self.blocks) == 0:
+            return 0
+        return self.get_last_block().total_work
+
+    # is_main_block checks if the block with block_hash at height is part of our blockchain
+    def is_main_block(self, height, block_hash):
+        return 1 <= height <= len(self.blocks) and self.blocks[height - 1].hash == block_hash
+
+    # get_block returns the block with block_hash, from our blockchain or a side branch. Returns None if we don't have it
+    def get_block(self, block_hash):
+        # the index may be shared with a newer version of this blockchain (see snapshot), check it's our block
+        height = self.block_index.get(block_hash)
+        if height is not None and self.is_main_block(height, block_hash):
+            return self.blocks[height - 1]
+        return self.side_blocks.get(block_hash)
+
+    # knows_block checks if we already have the block with block_hash at height, in our blockchain or on a side branch
+    def knows_block(self, height, block_hash):
+        return block_hash in self.side_blocks or self.is_main_block(height, block_hash)
+
+    # add_block adds a block. Blocks on top of our last block are added to our blockchain right away, blocks on top
+    # of an earlier block are kept on a side branch, and we switch to that branch once it's heavier than ours.
+    # Set check_signatures to False if the caller already checked them. Returns True if the block was accepted
+    def add_block(self, block, check_signatures=True):
+        # the block won't change anymore, set the blocks hash
+        block.hash = block.seal().compute_hash()        
+
+        # the usual case, a block on top of our last block (or the genesis block)
+        if len(self.blocks) == 0 or block.previous_hash == self.get_last_block().hash:
+            if not self.connect_block(block, check_signatures):
+                return False
+            self.prune_side_blocks()
+            return True
+
+        # do we have it already?
+        if self.knows_block(block.height, block.hash):
+            logger.info('Block %d is already known' % block.height)
+            return False
+
+        # find its parent, on a side branch or in our blockchain
+        if block.previous_hash in self.side_blocks:
+            parent = self.side_blocks[block.previous_hash]
+        elif self.is_main_block(block.height - 1, block.previous_hash):
+            parent = self.blocks[block.height - 2]
+        else:
+            # we don't know where this block goes, connect_block rejects it and logs why
+            return self.connect_block(block, check_signatures)
+
+        # forks deeper than MAX_FORK_DEPTH are not followed
+        if self.get_last_block().height - parent.height > MAX_FORK_DEPTH:
+            logger.error('Block %d is invalid: fork is deeper than %d blocks' % (block.height, MAX_FORK_DEPTH))
+            return False
+        # we can only fully check a side block when we switch to its branch, but its height, difficulty and proof of
+        # work are cheap to check now. Otherwise blocks claiming no work at all could fill our side branches
+        if block.height != parent.height + 1:
+            logger.error('Block %d is invalid: expected height is %d' % (block.height, parent.height + 1))
+            return False
+        previous = [parent]
+        if parent.height > 1:
+            grandparent = self.get_block(parent.previous_hash)
+            if grandparent is None:
+                logger.error('Block %d is invalid: its branch is incomplete' % block.height)
+                return False
+            previous.insert(0, grandparent)
+        if block.difficulty != next_difficulty(previous):
+            logger.error('Block %d is invalid: block.difficulty is %d should be %d' % (block.height, block.difficulty, next_difficulty(previous)))
+            return False
+        if not block.hash < block.difficulty_to_target():
+            logger.error('Block %d is invalid: block.hash is %s should be smaller than %s' % (block.height, block.hash, block.difficulty_to_target()))
+            return False
+
+        # keep it on a side branch
+        block.total_work = parent.total_work + 2 ** block.difficulty
+        self.side_blocks[block.hash] = block
+        logger.info('Block %d added to a side branch' % block.height)
+        # switch to its branch if it's heavier than ours. If the branch turns out to be invalid the block is rejected
+        if block.total_work > self.get_total_work() and not self.reorganize(block):
+            self.prune_side_blocks()
+            return False
+        self.prune_side_blocks()
+        return True
+
+    # reorganize switches our blockchain to the side branch ending with new_tip. Only the blocks after the fork are
+    # undone and the blocks of the new branch are applied. If the new branch is invalid we go back to ours
+    def reorganize(self, new_tip):
+        # walk back the side branch until we reach our blockchain
+        branch = [new_tip]
+        while not self.is_main_block(branch[-1].height - 1, branch[-1].previous_hash):
+            # the branch may be missing blocks we have already pruned
+            if branch[-1].previous_hash not in self.side_blocks:
+                logger.error('Branch of block %d is incomplete, keeping our blockchain' % new_tip.height)
+                return False
+            branch.append(self.side_blocks[branch[-1].previous_hash])
+        branch.reverse()
+        fork_height = branch[0].height - 1
+        logger.info('Switching to a heavier branch: replacing %d block(s) after block %d with %d block(s)' %
+            (self.get_blockchain_size() - fork_height, fork_height, len(branch)))
+
+        # undo our blocks after the fork and apply the branch
+        removed = self.rollback_to(fork_height)
+        for block in branch:
+            if not self.connect_block(block):
+                # the branch is invalid! forget the bad block and go back to our own blocks
+                logger.error('Branch is invalid, keeping our blockchain')
+                del self.side_blocks[block.hash]
+                self.rollback_to(fork_height)
+                for old_block in removed:
+                    self.connect_block(old_block, check_signatures=False)
+                return False
+
+        # the blocks of the new branch are no longer on a side branch, our old blocks are
+        for block in branch:
+            del self.side_blocks[block.hash]
+        for old_block in removed:
+            self.side_blocks[old_block.hash] = old_block
+        return True
+
+    # prune_side_blocks forgets side blocks too far below our last block, and the lowest ones if we have too many
+    def prune_side_blocks(self):
+        lowest_height = self.get_last_block().height - MAX_FORK_DEPTH
+        for block_hash, block in list(self.side_blocks.items()):
+            if block.height <= lowest_height:
+                del self.side_blocks[block_hash]
+        if len(self.side_blocks) > MAX_SIDE_BLOCKS:
+            by_height = sorted(self.side_blocks.values(), key=lambda b: b.height)
+            for block in by_height[:len(self.side_blocks) - MAX_SIDE_BLOCKS]:
+                del self.side_blocks[block.hash]
+
+    # connect_block adds a block on top of our last block. This function checks everything to make sure
+    # the added block is correct and sound. Set check_signatures to False if the caller already checked them
+    def connect_block(self, block, check_signatures=True):                  
+        # the genesis block is only accepted on an empty blockchain
+        if len(self.blocks) == 0 and block.height != 1:
+            logger.error('Block %d is invalid: expected height is 1' % block.height)
+            return False
+
         # these checks are for non-genesis blocks
-        if block.height > 1:  
+        if len(self.blocks) > 0:  
             # check height
             if block.height != self.get_last_block().height + 1:
                 logger.error('Block %d is invalid: expected height is %d' % (block.height, self.get_last_block().height + 1))
@@ -219,24 +842,39 @@ class Blockchain:
                 logger.error('Block %d is invalid: block.difficulty is %d should be %d' % (block.height, block.difficulty, self.compute_next_difficulty()))
                 return False
 
-        # now we check each transaction in this block
+        # verify all transaction signatures first, big blocks are checked in parallel
+        if check_signatures:
+            invalid = find_invalid_signature(block.transactions)
+            if invalid is not None:
+                logger.error('Block %d is invalid: invalid signature on transaction %d!' % (block.height, invalid))
+                return False
+
+        # now we check each transaction in this block. We update balances as we go, remembering what they were
+        # before in undo, so we can put them back if the block turns out to be invalid
+        undo = {}
         coinbase_found = False                
         for tx in block.transactions:
-
-            # verify transaction signature
-            if not tx.verify_signature():
-                logger.error('Block %d is invalid: invalid signature!' % block.height)
-                return False
+            # remember the balances this transaction is about to change. COINBASE is not a real address,
+            # it has no balance
+            if tx.from_pubkey == 'COINBASE':
+                changed = [tx.to_pubkey]
+            else:
+                changed = [tx.from_pubkey, tx.to_pubkey]
+            for address in changed:
+                if address not in undo:
+                    undo[address] = self.balances.get(address)
 
             # coinbase transaction logic
             if tx.from_pubkey == 'COINBASE':
                 # each block should have only 1 coinbase transaction!
                 if coinbase_found:
                     logger.error('Block %d is invalid: more than 1 COINBASE' % block.height)                    
+                    set_balances(self.balances, undo)
                     return False
                 # check reward amount
                 if tx.amount != BLOCK_REWARD:
                     logger.error('Block %d is invalid: invalid COINBASE amount %d' % (block.height, tx.amount))
+                    set_balances(self.balances, undo)
                     return False
                 # flag we've found the coinbase transaction
                 # we use this flag to check there is only 1 coinbase
@@ -245,6 +883,7 @@ class Blockchain:
                 # check if the 'from' public key has enough coins to give 
                 if not tx.from_pubkey in self.balances or self.balances[tx.from_pubkey] < tx.amount:
                     logger.error('Block %d is invalid: insufficient funds %d address %s' % (block.height, tx.amount, tx.from_pubkey))
+                    set_balances(self.balances, undo)
                     return False
                 else:                    
                     # update balance to account for spent coins
@@ -257,48 +896,226 @@ class Blockchain:
                 self.balances[tx.to_pubkey] = tx.amount
 
         # all ok! add the block to the blockchain
+        block.total_work = self.get_total_work() + 2 ** block.difficulty
         self.blocks.append(block)        
+        self.block_index[block.hash] = block.height
+        self.balance_changes.append({address: (before, self.balances.get(address)) for address, before in undo.items()})
+        # take a snapshot of balances every now and then
+        if block.height % BALANCE_SNAPSHOT_INTERVAL == 0:
+            self.balance_snapshots[block.height] = dict(self.balances)
+            self.prune_balance_history()
+        # write it to disk
+        if self.store is not None:
+            self.store.append(block)
+        # these transactions don't need to be mined anymore
+        if self.mempool is not None:
+            self.mempool.remove_block(block, self.balances)
+        # remember where each transaction is, so we can prove it's in the blockchain later. If the same
+        # transaction is in more than one block we keep the first one
+        for position, tx in enumerate(block.transactions):
+            self.tx_index.setdefault(tx.compute_hash(), (block.height, position))
         
         # success!
         return True
+
+    # prune_balance_history drops the oldest balance snapshots, keeping MAX_BALANCE_SNAPSHOTS of them, and the
+    # balance changes up to the oldest one left. Blocks before it can't be undone anymore
+    def prune_balance_history(self):
+        while len(self.balance_snapshots) > MAX_BALANCE_SNAPSHOTS:
+            del self.balance_snapshots[min(self.balance_snapshots)]
+        oldest = min(self.balance_snapshots)
+        # the list may be shared, replacing items keeps its length (and the heights of the other items)
+        for height in range(self.history_start + 1, oldest + 1):
+            self.balance_changes[height - 1] = None
+        self.history_start = max(self.history_start, oldest)
+
+    # rollback_block removes the last block from the blockchain and undoes its balance changes.
+    # Returns the removed block
+    def rollback_block(self):
+        # readers may share our lists, they keep the old ones
+        if self.shared:
+            self.blocks = list(self.blocks)
+            self.balance_changes = list(self.balance_changes)
+            self.shared = False
+        block = self.blocks.pop()
+        del self.block_index[block.hash]
+        changes = self.balance_changes.pop()
+        set_balances(self.balances, {address: before for address, (before, after) in changes.items()})
+        self.balance_snapshots.pop(block.height, None)
+        # forget the transactions of this block
+        for tx in block.transactions:
+            if self.tx_index.get(tx.compute_hash(), (None,))[0] == block.height:
+                del self.tx_index[tx.compute_hash()]
+        # they should be mined again
+        if self.mempool is not None:
+            self.mempool.add_transactions(block.transactions)
+        return block
+
+    # rollback_to removes blocks from the end of the blockchain until it has height blocks.
+    # Returns the removed blocks, in blockchain order
+    def rollback_to(self, height):
+        removed = []
+        while self.get_blockchain_size() > height:
+            removed.append(self.rollback_block())
+        removed.reverse()
+        # remove them from disk too
+        if self.store is not None and len(removed) > 0:
+            self.store.truncate(height)
+        return removed
+
+    # get_balances_at returns the balances right after the block at height was added (0 is before the genesis
+    # block). We start from the closest snapshot (or the current balances) and replay balance changes from there.
+    # Returns None if we don't keep the balances at that height anymore (see prune_balance_history)
+    def get_balances_at(self, height):
+        if height < self.history_start:
+            return None
+        size = self.get_blockchain_size()
+        # the snapshots right before and right after height, if we have them, and the current balances
+        below = height - height % BALANCE_SNAPSHOT_INTERVAL
+        starts = [h for h in (below, below + BALANCE_SNAPSHOT_INTERVAL) if h in self.balance_snapshots]
+        start = min(starts + [size], key=lambda h: abs(h - height))
+        if start == size:
+            balances = dict(self.balances)
+        else:
+            balances = dict(self.balance_snapshots[start])
+
+        # the balance changes we replay, they may have been pruned since this version of our blockchain was taken
+        changes = [self.balance_changes[h - 1] for h in range(min(start, height) + 1, max(start, height) + 1)]
+        if None in changes:
+            return None
+        # replay blocks forward, setting balances to what they were after each block
+        if start < height:
+            for block_changes in changes:
+                set_balances(balances, {address: after for address, (before, after) in block_changes.items()})
+        # or backward, setting balances to what they were before each block
+        else:
+            for block_changes in reversed(changes):
+                set_balances(balances, {address: before for address, (before, after) in block_changes.items()})
+        return balances
+
+    # get_blocks returns the blocks with heights from start to end (both included)
+    def get_blocks(self, start, end):
+        # heights start from 1
+        return self.blocks[max(start, 1) - 1:max(end, 0)]
+
+    # add_blocks adds a list of consecutive blocks to the blockchain. The signatures of all the blocks are
+    # checked at once, so they can be spread over our verification pool
+    def add_blocks(self, blocks):
+        transactions = [tx for block in blocks for tx in block.transactions]
+        invalid = find_invalid_signature(transactions)
+
+        for block in blocks:
+            # is the invalid signature in this block?
+            if invalid is not None and invalid < len(block.transactions):
+                logger.error('Block %d is invalid: invalid signature on transaction %d!' % (block.height, invalid))
+                return False
+            elif invalid is not None:
+                invalid -= len(block.transactions)
+
+            # call add_block to add this block to the blockchain, checking everything else!
+            if self.add_block(block, check_signatures=False):	
+                logger.info('Block %d processed successfully!' % block.height)	                    
+            else:
+                return False
+        return True
     
-    # compute_next_difficulty calculates the difficulty for next block. It checks the time it took to 
-    # create the last two blocks and compares it to BLOCK_TIME_IN_SECONDS and acts accordingly
+    # get_merkle_proof returns a proof that the transaction with tx_hash is in the blockchain: the header of its
+    # block and the merkle branch of the transaction. Returns None if we don't know the transaction
+    def get_merkle_proof(self, tx_hash):
+        height, position = self.tx_index.get(tx_hash, (None, None))
+        # the index may be shared with a newer version of this blockchain (see snapshot), check it's our transaction
+        if height is None or height > len(self.blocks):
+            return None
+        # heights start from 1
+        block = self.blocks[height - 1]
+        tx_hashes = [tx.compute_hash() for tx in block.transactions]
+        if position >= len(tx_hashes) or tx_hashes[position] != tx_hash:
+            return None
+        return {
+            'tx_hash': tx_hash,
+            'height': height,
+            'block_hash': block.hash,
+            'header': block.header_fields(),
+            'branch': compute_merkle_branch(tx_hashes, position)}
+
+    # compute_next_difficulty calculates the difficulty for next block, see next_difficulty
     def compute_next_difficulty(self):        
-        # if we have more than 1 block
-        if len(self.blocks) > 1:            
-            # calculate the time difference between last 2 blocks
-            block_time_diff = self.get_last_block().timestamp - self.blocks[-2].timestamp                            
-            # tweak difficulty based on time
-            if block_time_diff < BLOCK_TIME_IN_SECONDS:
-                # increase difficulty if the last two blocks are mined fast
-                return self.get_last_block().difficulty + 1
-            else:
-                # decrease difficulty if the last two blocks are mined slow
-                return self.get_last_block().difficulty - 1
-        else:
-            # block 1 is mined with START_DIFFICULTY
-            return START_DIFFICULTY
+        return next_difficulty(self.blocks[-2:])
     
+    # snapshot returns a read-only copy of this blockchain as it is now, which doesn't change while blocks are added
+    # or removed here. Our blocks and balance changes grow with our blockchain, they are shared as views of their
+    # current length (see SharedList), rollback_block copies them before removing anything. The other dicts are
+    # small and copied. The transaction and block indexes are too big to copy every time, they are shared and
+    # lookups in them are checked against the copy's own blocks
+    def snapshot(self):
+        snapshot = copy.copy(self)
+        snapshot.blocks = SharedList(self.blocks, len(self.blocks))
+        snapshot.balances = dict(self.balances)
+        snapshot.balance_changes = SharedList(self.balance_changes, len(self.balance_changes))
+        snapshot.balance_snapshots = dict(self.balance_snapshots)
+        self.shared = True
+        snapshot.side_blocks = dict(self.side_blocks)
+        # a snapshot never writes anything
+        snapshot.store = None
+        snapshot.mempool = None
+        return snapshot
+
+    # attach_store starts writing our blocks to a block store. Blocks the store has in common with us are kept,
+    # the rest of the store is rewritten with our blocks
+    def attach_store(self, store):
+        common = 0
+        while common < min(store.get_size(), self.get_blockchain_size()) and store.get_hash(common + 1) == self.blocks[common].hash:
+            common += 1
+        store.truncate(common)
+        for block in self.blocks[common:]:
+            store.append(block)
+        store.sync()
+        self.store = store
+
+    # load_from_store loads our own blocks from a block store and keeps writing new blocks to it. These blocks were
+    # checked when we first added them, so we trust their signatures and don't check them again
+    def load_from_store(self, store):
+        blocks = store.read_blocks()
+        for block_data in blocks:
+            block = Block()
+            try:
+                block.load_from(json.loads(block_data))
+            except (ValueError, KeyError, TypeError, UnicodeDecodeError):
+                # the record itself is damaged
+                logger.error('Block store is damaged after block %d' % self.get_blockchain_size())
+                break
+            block.hash = block.compute_hash()
+            # stop at the first block that's not what the index says or doesn't fit, the store is cut there
+            if block.hash != store.get_hash(block.height) or not self.connect_block(block, check_signatures=False):
+                logger.error('Block store is damaged after block %d' % self.get_blockchain_size())
+                break
+        blocks.close()
+        self.attach_store(store)
+
     # load_from accpets a JSON dump of a blockchain and recreates it as an object in self
     def load_from(self, json_dump):	
         # init an empty list of blocks
         self.blocks = []
 
-        # for each block in dump
-        for block_data_json in json_dump:	
-            # create the block
-            block = Block()
-            # fill it with data we received
-            block_data = json.loads(block_data_json)
-            if block.load_from(block_data):                
-                # call add_block to add this block to the blockchain, checking everything!
-                if self.add_block(block):	
-                    logger.info('Block %d processed successfully!' % block.height)	                    
-                else:
-                    # add_block failed! return False as error
-                    logger.error('Load failed!')	
-                    return False	
+        # we take LOAD_BATCH_BLOCKS blocks from the dump at a time
+        dump = iter(json_dump)
+        while True:
+            batch = []
+            for block_data_json in itertools.islice(dump, LOAD_BATCH_BLOCKS):
+                # create the block
+                block = Block()
+                # fill it with data we received
+                block_data = json.loads(block_data_json)
+                if block.load_from(block_data):
+                    batch.append(block)
+            if len(batch) == 0:
+                break
+
+            # add_blocks checks everything, including the signatures of the whole batch at once
+            if not self.add_blocks(batch):
+                # add_blocks failed! return False as error
+                logger.error('Load failed!')	
+                return False	
 
         # success!
         logger.info('Loaded successfully!')	
@@ -0,0 +1,81 @@
+# cache.py provides a small LRU (least recently used) cache used by our node to avoid repeating expensive work
+
+from collections import OrderedDict
+import threading
+import time
+
+# the LRUCache class maps keys to values and holds at most maxsize entries. When it's full, the entry
+# used least recently is thrown away. With max_bytes, entries are also thrown away while the sizes given to put
+# add up to more than that. With ttl, entries are forgotten ttl seconds after they were put. It counts hits and
+# misses so we can see how useful it is
+class LRUCache:
+    # constructor
+    def __init__(self, maxsize, max_bytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # when each entry expires, if we have a ttl
+        self.expires = {}
+        # OrderedDict remembers the order of keys, we move a key to the end every time it's used
+        self.entries = OrderedDict()
+        # the size of each entry, and of all of them
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Flask handlers, the miner and sync all use our caches at the same time
+        self.lock = threading.Lock()
+
+    # get returns the value for key, or None if we don't have it
+    def get(self, key):
+        with self.lock:
+            if key in self.expires and self.expires[key] <= time.time():
+                self.remove(key)
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    # put adds (or updates) the value for key, taking size bytes, evicting the least recently used entries if
+    # we're full
+    def put(self, key, value, size=0):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.total_bytes += size - self.sizes.get(key, 0)
+            self.sizes[key] = size
+            if self.ttl is not None:
+                self.expires[key] = time.time() + self.ttl
+            self.evict()
+
+    # pop removes key from the cache, if it's there
+    def pop(self, key):
+        with self.lock:
+            self.remove(key)
+
+    # remove removes key from the cache, if it's there. The caller holds our lock
+    def remove(self, key):
+        self.entries.pop(key, None)
+        self.total_bytes -= self.sizes.pop(key, 0)
+        self.expires.pop(key, None)
+
+    # resize changes the maximum number of entries
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            self.evict()
+
+    # evict throws away the least recently used entries until we're within our limits. The caller holds our lock
+    def evict(self):
+        while len(self.entries) > self.maxsize or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+            self.remove(next(iter(self.entries)))
+
+    # stats returns the size of the cache along with hit and miss counters
+    def stats(self):
+        stats = {'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+        if self.max_bytes is not None:
+            stats['bytes'] = self.total_bytes
+            stats['max_bytes'] = self.max_bytes
+        return stats
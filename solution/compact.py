@@ -0,0 +1,61 @@
+# compact.py provides compact blocks: a block header along with a short ID for each of its transactions, instead of
+# the transactions themselves. Our peers have most transactions of a new block in their transaction pool already,
+# so they rebuild the block from their pool and only ask for the few they are missing. A transaction with its two
+# addresses and signature takes over a thousand bytes, its short ID takes a dozen
+
+from hashlib import sha256
+from blockchain import Block, load_transaction
+
+# length of a short ID in hex characters (48 bits). Two transactions of a pool may still get the same short ID,
+# we then ask for the transaction like any missing one
+SHORT_ID_LENGTH = 12
+
+# short_id returns the short ID of the transaction with tx_hash in the block with block_hash. The block hash is
+# mixed in, so nobody can create a transaction that collides with another one in every block
+def short_id(block_hash, tx_hash):
+    return sha256((block_hash + tx_hash).encode()).hexdigest()[:SHORT_ID_LENGTH]
+
+# encode_compact_block returns the compact block of a block as a dict: its 'header' (see Block.header_fields),
+# the 'short_ids' of its transactions and the transactions nobody else has ('prefilled', the coinbase transaction
+# by position)
+def encode_compact_block(block):
+    block_hash = block.compute_hash()
+    prefilled = {}
+    for position, tx in enumerate(block.transactions):
+        if tx.from_pubkey == 'COINBASE':
+            # JSON keys are strings, so positions are too
+            prefilled[str(position)] = str(tx)
+    return {'header': block.header_fields(),
+            'short_ids': [short_id(block_hash, tx.compute_hash()) for tx in block.transactions],
+            'prefilled': prefilled}
+
+# match_transactions finds the transactions of a compact block with block_hash in pool (a Mempool). Returns the
+# list of transactions, with None for the ones we don't have, and the list of their positions
+def match_transactions(compact, block_hash, pool):
+    by_short_id = {}
+    for tx in pool:
+        key = short_id(block_hash, tx.compute_hash())
+        # two transactions with the same short ID, we can't tell which one the block has
+        by_short_id[key] = None if key in by_short_id else tx
+    transactions = []
+    for position, key in enumerate(compact['short_ids']):
+        prefilled = compact['prefilled'].get(str(position))
+        transactions.append(load_transaction(prefilled) if prefilled is not None else by_short_id.get(key))
+    return transactions, [position for position, tx in enumerate(transactions) if tx is None]
+
+# build_block creates the block of a compact block from its transactions. Returns None if the block doesn't
+# match its header, for example if a short ID collided with another transaction of our pool
+def build_block(compact, transactions):
+    header = compact['header']
+    block = Block()
+    block.fill_block(header['height'], header['difficulty'], header['previous_hash'], list(transactions), header['timestamp'])
+    block.nonce = header['nonce']
+    if block.merkle_root() != header['merkle_root']:
+        return None
+    return block.seal()
+
+# check_header checks the header of a compact block hashes to block_hash, before we look for its transactions
+def check_header(compact, block_hash):
+    header = Block()
+    header.load_header(compact['header'])
+    return header.compute_hash() == block_hash
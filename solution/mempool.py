@@ -0,0 +1,179 @@
+# mempool.py provides the transaction pool of our node: transactions that are created but not yet mined in a block.
+# Transactions are indexed by hash and by sender, and we keep the total amount each address is about to spend, so
+# checking a new transaction doesn't need to look at the rest of the pool
+
+from collections import OrderedDict
+import threading
+import logging
+import math
+
+# get logger to print stuff
+logger = logging.getLogger()
+
+# the pool holds at most this many transactions, taking at most this many bytes (as JSON dumps)
+MAX_POOL_TRANSACTIONS = 5000
+MAX_POOL_BYTES = 5 * 1024 * 1024
+
+# valid_amount checks the amount of a new transaction is a positive number. JSON booleans are ints in python,
+# and python's json parses NaN and Infinity, which would break every balance they touch
+def valid_amount(amount):
+    return isinstance(amount, (int, float)) and not isinstance(amount, bool) and math.isfinite(amount) and amount > 0
+
+# payable checks a transaction could go in a block on top of balances, with the same rules as
+# Blockchain.connect_block: a valid amount and a sender with a balance covering it, after spent coins of the
+# sender's earlier transactions
+def payable(tx, balances, spent=0):
+    return valid_amount(tx.amount) and tx.from_pubkey in balances and balances[tx.from_pubkey] - spent >= tx.amount
+
+# the Mempool class is our transaction pool. When it's full, transactions of the address using the most space
+# are evicted first (its newest ones), so a single address can't push everyone else out of the pool
+class Mempool:
+    # constructor
+    def __init__(self, max_transactions=MAX_POOL_TRANSACTIONS, max_bytes=MAX_POOL_BYTES):
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        # all transactions by hash, in the order they arrived
+        self.transactions = OrderedDict()
+        # the hashes of each sender's transactions, in the order they arrived
+        self.by_sender = {}
+        # the total amount of each sender's transactions, these coins are about to be spent
+        self.pending = {}
+        # size of each transaction in bytes, and of the whole pool and each sender's transactions
+        self.sizes = {}
+        self.total_bytes = 0
+        self.sender_bytes = {}
+        # goes up every time a transaction is added or removed, so the miner can tell when the pool changed
+        self.version = 0
+        # Flask handlers, the miner and sync all use the pool at the same time
+        self.lock = threading.RLock()
+
+    # returns the number of transactions in the pool
+    def __len__(self):
+        return len(self.transactions)
+
+    # iterates over the transactions in the order they arrived. We go over a copy, so the pool can change meanwhile
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.transactions.values()))
+
+    # checks if the transaction with tx_hash is in the pool
+    def __contains__(self, tx_hash):
+        return tx_hash in self.transactions
+
+    # get returns the transaction with tx_hash, or None if it's not in the pool
+    def get(self, tx_hash):
+        return self.transactions.get(tx_hash)
+
+    # pending_debit returns the amount address is about to spend with the transactions in the pool
+    def pending_debit(self, address):
+        return self.pending.get(address, 0)
+
+    # add adds a transaction to the pool. balances are the confirmed balances, the transaction should be payable
+    # from them along with the sender's other transactions in the pool. Pass None to skip this check, for
+    # transactions that were already in a block. Returns True if the transaction was added
+    def add(self, tx, balances=None):
+        with self.lock:
+            if not self.insert(tx, balances):
+                return False
+            # make room if we're over our limits, this may evict the new transaction itself
+            self.evict()
+            return tx.compute_hash() in self.transactions
+
+    # add_batch adds a list of transactions at once: no other transaction gets in the pool while we add them, and
+    # we make room only once at the end. balances are the confirmed balances of their senders (see add).
+    # Returns a list with True for each transaction added and False for each one rejected
+    def add_batch(self, transactions, balances):
+        with self.lock:
+            inserted = [self.insert(tx, balances) for tx in transactions]
+            self.evict()
+            return [ok and tx.compute_hash() in self.transactions for tx, ok in zip(transactions, inserted)]
+
+    # insert adds a transaction to the pool without checking our limits, see add
+    def insert(self, tx, balances):
+        tx_hash = tx.compute_hash()
+        with self.lock:
+            if tx_hash in self.transactions:
+                logger.info('Transaction %s is already in the pool' % tx_hash)
+                return False
+            if balances is not None and not payable(tx, balances, self.pending_debit(tx.from_pubkey)):
+                logger.error('Transaction %s rejected: %s can\'t pay %s with %s, %s already pending' % (tx_hash, tx.from_pubkey, tx.amount, balances.get(tx.from_pubkey), self.pending_debit(tx.from_pubkey)))
+                return False
+
+            self.transactions[tx_hash] = tx
+            self.by_sender.setdefault(tx.from_pubkey, OrderedDict())[tx_hash] = True
+            self.pending[tx.from_pubkey] = self.pending_debit(tx.from_pubkey) + tx.amount
+            self.sizes[tx_hash] = len(str(tx))
+            self.total_bytes += self.sizes[tx_hash]
+            self.sender_bytes[tx.from_pubkey] = self.sender_bytes.get(tx.from_pubkey, 0) + self.sizes[tx_hash]
+            self.version += 1
+            return True
+
+    # remove removes the transaction with tx_hash from the pool, if it's there. Returns the removed transaction
+    def remove(self, tx_hash):
+        with self.lock:
+            tx = self.transactions.pop(tx_hash, None)
+            if tx is None:
+                return None
+            sender = tx.from_pubkey
+            del self.by_sender[sender][tx_hash]
+            self.pending[sender] -= tx.amount
+            size = self.sizes.pop(tx_hash)
+            self.total_bytes -= size
+            self.sender_bytes[sender] -= size
+            self.version += 1
+            # forget senders without transactions
+            if len(self.by_sender[sender]) == 0:
+                del self.by_sender[sender]
+                del self.pending[sender]
+                del self.sender_bytes[sender]
+            return tx
+
+    # evict removes transactions until the pool is within its limits. The newest transaction of the sender
+    # using the most bytes goes first
+    def evict(self):
+        with self.lock:
+            while len(self.transactions) > self.max_transactions or self.total_bytes > self.max_bytes:
+                sender = max(self.sender_bytes, key=self.sender_bytes.get)
+                tx_hash = next(reversed(self.by_sender[sender]))
+                logger.info('Transaction pool is full, evicting %s' % tx_hash)
+                self.remove(tx_hash)
+
+    # remove_block removes the transactions included in a block we've just added to our blockchain. balances are the
+    # balances after the block: the senders in the block may not have enough coins left for all their transactions
+    # in the pool anymore, their newest transactions are dropped until they do
+    def remove_block(self, block, balances):
+        with self.lock:
+            senders = set()
+            for tx in block.transactions:
+                self.remove(tx.compute_hash())
+                senders.add(tx.from_pubkey)
+            for sender in senders:
+                while sender in self.by_sender and self.pending[sender] > balances.get(sender, 0):
+                    tx_hash = next(reversed(self.by_sender[sender]))
+                    logger.info('Transaction %s dropped: %s does not have enough coins anymore' % (tx_hash, sender))
+                    self.remove(tx_hash)
+
+    # add_transactions puts back the transactions of a block removed from our blockchain, so they can be mined again
+    def add_transactions(self, transactions):
+        with self.lock:
+            for tx in transactions:
+                # coinbase transactions only make sense in their own block
+                if tx.from_pubkey != 'COINBASE' and tx.compute_hash() not in self.transactions:
+                    self.add(tx)
+
+    # select returns the transactions to put in a new block, in the order they arrived, skipping the ones that
+    # aren't payable from balances
+    def select(self, balances):
+        selected = []
+        spent = {}
+        for tx in self:
+            if not payable(tx, balances, spent.get(tx.from_pubkey, 0)):
+                continue
+            spent[tx.from_pubkey] = spent.get(tx.from_pubkey, 0) + tx.amount
+            selected.append(tx)
+        return selected
+
+    # stats returns the number of transactions and bytes in the pool along with our limits
+    def stats(self):
+        return {'size': len(self.transactions), 'bytes': self.total_bytes,
+                'max_size': self.max_transactions, 'max_bytes': self.max_bytes}
@@ -0,0 +1,222 @@
+# mining.py provides the mining engine for our node. Mining means hashing the same block header over and over
+# with a different nonce, so the engine prepares everything that doesn't change between attempts only once
+
+from hashlib import sha256
+import json
+import time
+
+from workers import worker_context
+
+# the engine works in batches of nonces. Between two batches it refreshes the block timestamp and checks if
+# it should stop (for example because a new block was received from the network)
+NONCE_BATCH_SIZE = 1000
+
+# how often (in seconds) the parallel engine checks if it should stop its workers
+STOP_POLL_INTERVAL = 0.005
+
+# HeaderTemplate is a block header serialized once, with holes for the nonce and the timestamp.
+# It produces exactly the same bytes as Block.compute_hash, so the hashes are identical
+class HeaderTemplate:
+    # constructor, fields is the header dict returned by Block.header_fields()
+    def __init__(self, fields):
+        # json.dumps writes a dict as '{"key": value, "key": value}', we do the same thing piece by piece
+        # and cut the string where the nonce and the timestamp go
+        chunks = ['{']
+        holes = []
+        for i, (key, value) in enumerate(fields.items()):
+            if i > 0:
+                chunks[-1] += ', '
+            chunks[-1] += json.dumps(key) + ': '
+            if key in ('nonce', 'timestamp'):
+                # leave a hole and start a new chunk
+                holes.append(key)
+                chunks.append('')
+            else:
+                chunks[-1] += json.dumps(value)
+        chunks[-1] += '}'
+        if holes != ['nonce', 'timestamp']:
+            raise ValueError('header must contain nonce followed by timestamp')
+
+        # everything before the nonce never changes, so we feed it to sha256 only once. This is the 'midstate'
+        self.midstate = sha256(chunks[0].encode())
+        # the text between the nonce and the timestamp, and after the timestamp
+        self.middle = chunks[1]
+        self.suffix = chunks[2]
+
+    # tail returns the bytes following the nonce for a given timestamp
+    def tail(self, timestamp):
+        return (self.middle + json.dumps(timestamp) + self.suffix).encode()
+
+# search_nonce tries nonces start, start + step, start + 2 * step, ... on a header template until it finds a hash
+# smaller than target or should_stop returns True. Returns a (nonce, timestamp, hashes) tuple, nonce is None if
+# we were stopped before finding a solution. progress, if given, is called with the number of hashes of each
+# full batch. This is a plain function so it can also run in another process
+def search_nonce(template, target, should_stop, start=0, step=1, progress=None):
+    nonce = start
+    hashes = 0
+    while True:
+        # the timestamp only changes once per batch
+        timestamp = time.time()
+        tail = template.tail(timestamp)
+        for _ in range(NONCE_BATCH_SIZE):
+            h = template.midstate.copy()
+            h.update(b'%d' % nonce)
+            h.update(tail)
+            hashes += 1
+            # compare integers, no need to format the target as a hex string
+            if int.from_bytes(h.digest(), 'big') < target:
+                return nonce, timestamp, hashes
+            nonce += step
+        if progress is not None:
+            progress(NONCE_BATCH_SIZE)
+        # check if we should give up on this block
+        if should_stop():
+            return None, timestamp, hashes
+
+# the MiningEngine class searches nonces for blocks and keeps track of the hash rate
+class MiningEngine:
+    # constructor
+    def __init__(self):
+        # number of hashes computed and seconds spent on the block we're mining (or the last one), updated after
+        # every batch of nonces
+        self.hashes = 0
+        self.elapsed = 0.0
+
+    # hash_rate returns the hashes per second achieved on the block we're mining (or the last one)
+    def hash_rate(self):
+        if self.elapsed == 0:
+            return 0.0
+        return self.hashes / self.elapsed
+
+    # search finds a nonce for block, it sets block.nonce and block.timestamp and returns True when solved.
+    # It returns False if should_stop returned True before a solution was found. refresh is called between batches,
+    # if it returns a new list of transactions the block gets them and we keep searching with the new header
+    def search(self, block, should_stop, refresh=None):
+        started = time.time()
+        self.hashes = 0
+        self.elapsed = 0.0
+        nonce = 0
+
+        # count adds the hashes of a batch as soon as it's done, so hash_rate is up to date while we search
+        def count(hashes):
+            self.hashes += hashes
+            self.elapsed = time.time() - started
+
+        while True:
+            template = HeaderTemplate(block.header_fields())
+            # the new transactions returned by refresh, if any
+            update = [None]
+
+            # stop_or_refresh stops the search if we should stop, or if there are new transactions for the block
+            def stop_or_refresh():
+                if should_stop():
+                    return True
+                if refresh is not None:
+                    update[0] = refresh()
+                return update[0] is not None
+
+            counted = self.hashes
+            solution, timestamp, hashes = search_nonce(template, block.target(), stop_or_refresh, nonce, progress=count)
+            # count saw the full batches only
+            self.hashes = counted + hashes
+            self.elapsed = time.time() - started
+            if solution is not None:
+                block.nonce = solution
+                block.timestamp = timestamp
+                return True
+            if update[0] is None:
+                return False
+            # carry on with the next nonces, on the new header
+            block.set_transactions(update[0])
+            nonce += hashes
+
+# this event is shared by all mining worker processes. It is set when the search should stop, either because
+# a worker found a solution or because a new block was received from the network
+_stop_event = None
+# the number of hashes computed by all workers on the current header, shared by all mining worker processes
+_hash_counter = None
+
+# _init_worker runs once in every mining worker process and stores the shared stop event and hash counter
+def _init_worker(stop_event, hash_counter):
+    global _stop_event, _hash_counter
+    _stop_event = stop_event
+    _hash_counter = hash_counter
+
+# _count_hashes runs in a worker process after every batch of nonces and adds its hashes to the shared counter
+def _count_hashes(hashes):
+    with _hash_counter.get_lock():
+        _hash_counter.value += hashes
+
+# _search_worker runs in a worker process and searches its share of the nonce space
+def _search_worker(fields, target, start, step):
+    # hashlib objects can't be sent to another process, so each worker builds its own template
+    template = HeaderTemplate(fields)
+    result = search_nonce(template, target, _stop_event.is_set, start, step, progress=_count_hashes)
+    # we found a solution! tell the other workers to stop
+    if result[0] is not None:
+        _stop_event.set()
+    return result
+
+# the ParallelMiningEngine class mines on a pool of worker processes. The nonce space is split between
+# workers: worker i tries nonces i, i + workers, i + 2 * workers, ... so no two workers try the same nonce
+class ParallelMiningEngine(MiningEngine):
+    # constructor, workers is the number of processes to mine with
+    def __init__(self, workers):
+        super().__init__()
+        self.workers = workers
+        # workers only hash and use the event and counter made here, none of our locks, so they can be forked
+        context = worker_context()
+        self.stop_event = context.Event()
+        self.hash_counter = context.Value('q', 0)
+        # the pool is kept for the lifetime of the node, so we don't pay for starting processes on every block
+        self.pool = context.Pool(workers, initializer=_init_worker, initargs=(self.stop_event, self.hash_counter))
+
+    # search finds a nonce for block using all workers, see MiningEngine.search
+    def search(self, block, should_stop, refresh=None):
+        started = time.time()
+        self.hashes = 0
+        self.elapsed = 0.0
+        while True:
+            # the hashes of the previous headers, the workers count the ones of this header as they go
+            counted = self.hashes
+            returned = 0
+            self.hash_counter.value = 0
+            self.stop_event.clear()
+            fields = block.header_fields()
+            target = block.target()
+            # give every worker its own slice of the nonce space
+            pending = [self.pool.apply_async(_search_worker, (fields, target, i, self.workers))
+                       for i in range(self.workers)]
+
+            solution = None
+            transactions = None
+            # wait for all workers to return, the first solution wins
+            while pending:
+                # stop all workers if a new block was received, or if there are new transactions for the block
+                if should_stop():
+                    self.stop_event.set()
+                elif refresh is not None and transactions is None and not self.stop_event.is_set():
+                    transactions = refresh()
+                    if transactions is not None:
+                        self.stop_event.set()
+                pending[0].wait(STOP_POLL_INTERVAL)
+                for result in [r for r in pending if r.ready()]:
+                    pending.remove(result)
+                    nonce, timestamp, hashes = result.get()
+                    returned += hashes
+                    if nonce is not None and solution is None:
+                        solution = (nonce, timestamp)
+                self.hashes = counted + self.hash_counter.value
+                self.elapsed = time.time() - started
+            # the counter saw the full batches only
+            self.hashes = counted + returned
+            self.elapsed = time.time() - started
+
+            # a solution found before the workers stopped is for the old header, we keep it
+            if solution is not None:
+                block.nonce, block.timestamp = solution
+                return True
+            if transactions is None:
+                return False
+            # start the workers again on the new header
+            block.set_transactions(transactions)
@@ -0,0 +1,90 @@
+# network.py provides the HTTP client our node uses to talk to its peers. Every peer gets its own keep-alive
+# session, so we don't open a new connection for each request, and requests to many peers run at the same time,
+# so one slow peer doesn't hold back the others
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import time
+import logging
+
+import requests
+
+# get logger to print stuff
+logger = logging.getLogger()
+
+# seconds to wait for a peer to accept our connection and to send its response
+CONNECT_TIMEOUT = 3.0
+READ_TIMEOUT = 10.0
+
+# seconds a whole round of requests (like asking every peer for its blockchain size) may take. Peers that haven't
+# answered by then are skipped for this round
+ROUND_DEADLINE = 15.0
+
+# number of threads sending requests to peers
+FANOUT_WORKERS = 16
+
+# the sessions we keep open, one per peer address
+sessions = {}
+sessions_lock = threading.Lock()
+
+# the pool of threads used by fan_out
+executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='peer')
+
+# get_session returns the keep-alive session for a peer, creating it the first time
+def get_session(peer_address):
+    with sessions_lock:
+        session = sessions.get(peer_address)
+        if session is None:
+            session = requests.Session()
+            # several threads may talk to the same peer at once, keep enough connections for all of them
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=FANOUT_WORKERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[peer_address] = session
+        return session
+
+# close_session closes the session of a peer we don't talk to anymore
+def close_session(peer_address):
+    with sessions_lock:
+        session = sessions.pop(peer_address, None)
+    if session is not None:
+        session.close()
+
+# request sends a request to path on a peer using its session and logs how long the peer took to answer.
+# Raises requests.exceptions.RequestException if the peer can't be reached or is too slow
+def request(method, peer_address, path, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    started = time.time()
+    try:
+        response = get_session(peer_address).request(method, peer_address + path, **kwargs)
+    except requests.exceptions.RequestException as e:
+        logger.info('%s %s%s failed after %.1f ms: %s' % (method, peer_address, path, (time.time() - started) * 1000, e))
+        raise
+    logger.info('%s %s%s: %d in %.1f ms' % (method, peer_address, path, response.status_code, (time.time() - started) * 1000))
+    return response
+
+# get sends a GET request to a peer, see request
+def get(peer_address, path, **kwargs):
+    return request('GET', peer_address, path, **kwargs)
+
+# post sends a POST request to a peer, see request
+def post(peer_address, path, **kwargs):
+    return request('POST', peer_address, path, **kwargs)
+
+# fan_out calls call(peer_address) for all peer_addresses at the same time and waits at most deadline seconds.
+# Returns a dict of peer address to (result, error): error is the exception raised by call, or a TimeoutError
+# for peers that didn't finish in time
+def fan_out(peer_addresses, call, deadline=ROUND_DEADLINE):
+    futures = {executor.submit(call, peer_address): peer_address for peer_address in peer_addresses}
+    done, not_done = wait(futures, timeout=deadline)
+    results = {}
+    for future, peer_address in futures.items():
+        if future in not_done:
+            # the thread keeps going until the request times out, we just don't wait for it
+            future.cancel()
+            results[peer_address] = (None, TimeoutError('no answer in %.1f seconds' % deadline))
+        elif future.exception() is not None:
+            results[peer_address] = (None, future.exception())
+        else:
+            results[peer_address] = (future.result(), None)
+    return results
@@ -1,6 +1,9 @@
 # node.py defines a node in network. It contains the general operation of a node in a blockchain
 
-from blockchain import Block, Blockchain, Transaction
+from blockchain import Block, Blockchain, Transaction, OrphanPool, signature_cache, check_headers, MAX_FORK_DEPTH
+from mining import MiningEngine, ParallelMiningEngine
+from store import BlockStore
+from mempool import Mempool, valid_amount
 import requests
 import json
 import time
@@ -9,6 +12,10 @@ import Crypto
 from Crypto.PublicKey import RSA
 from Crypto import Random
 import base64
+import atexit
+import threading
+import os
+from workers import worker_context, map_batches
 
 # get logger to print stuff
 logger = logging.getLogger()
@@ -19,88 +26,243 @@ KEY_LENGTH = 2048
 # 10 coins will be awarded to the miner who solves a block! (finds its nonce)
 BLOCK_REWARD = 10
 
+# when syncing with a peer we look for the last block we have in common, starting with the last SYNC_WINDOW
+# blocks. The window doubles each time we don't find one, up to SYNC_PAGE_SIZE blocks
+SYNC_WINDOW = 16
+# the maximum number of blocks we ask a peer for at once
+SYNC_PAGE_SIZE = 100
+# headers are small, we download this many at a time
+SYNC_HEADER_PAGE_SIZE = 2000
+
+# while mining, the transactions of our block are updated with new ones from the pool at most once every
+# TEMPLATE_REFRESH_INTERVAL seconds. Each update changes the header the miner hashes
+TEMPLATE_REFRESH_INTERVAL = 1.0
+
+# signing is slow (2048 bit RSA!), so batches of new transactions are signed on a pool of processes,
+# SIGN_BATCH_SIZE transactions at a time
+SIGN_BATCH_SIZE = 64
+# with fewer transactions than this, sending them to other processes costs more than it saves
+PARALLEL_SIGN_THRESHOLD = 32
+# number of processes signing transactions
+SIGN_WORKERS = os.cpu_count() or 1
+
+# the private key of our node, in a signing worker process
+_signing_key = None
+
+# _init_signer runs once in every signing worker process and loads our private key. pycrypto's random number
+# generator refuses to run in a forked process until it's told about the fork
+def _init_signer(key_data):
+    global _signing_key
+    Random.atfork()
+    _signing_key = RSA.importKey(key_data)
+
+# _sign_batch runs in a signing worker process and signs a list of transaction hashes
+def _sign_batch(tx_hashes):
+    return [_signing_key.sign(tx_hash.encode(), '')[0] for tx_hash in tx_hashes]
+
 # the Node class defines a Node and it's operation
 class Node:
     # constructor
     def __init__(self):
         # init the transaction pool (unmined transactions)
-        self.transaction_pool = []
-        # create our blockchain!
+        self.transaction_pool = Mempool()
+        # create our blockchain! it takes mined transactions out of our pool
         self.blockchain = Blockchain()        
+        self.blockchain.mempool = self.transaction_pool
+        # all changes to our blockchain are made holding this lock, one at a time
+        self.write_lock = threading.RLock()
+        # relay_transactions is called with the transactions we create, to send them to our peers. app.py sets it
+        self.relay_transactions = None
+        # blocks that arrived before their parent, they are added once it arrives (see add_block)
+        self.orphans = OrphanPool()
+        # a read-only copy of our blockchain, replaced after every change. Readers use it instead of self.blockchain,
+        # so they never see a half-added block and never wait for the lock
+        self.chain = self.blockchain.snapshot()
         # this flag is used to signal the miner if a new block is received from the network
         # it moves forward to the next block, discarding the current minining operation
         self.new_block_received = False        
+        # the mining engine searches nonces for our block candidates
+        self.mining_engine = MiningEngine()
+        # the transaction pool version and time our current block candidate's transactions were picked at
+        self.template_version = None
+        self.template_time = 0
         # generate a key for this node. this key is this node's identity and is used to sign transactions
         # on behalf of this node.
         self.private_key = RSA.generate(KEY_LENGTH, Random.new().read)        
+        # we use a DER dump of the public key to calculate the address. DER is basically a binary dump of the public key.
+        # our key never changes, so we only do this once
+        self._address = base64.b64encode(self.private_key.publickey().exportKey('DER')).decode()
+        # the pool of processes signing transactions. RSA signing draws random numbers from pycrypto's generator,
+        # which is guarded by a lock our request handlers take whenever they sign. A process forked while one of them
+        # holds it would wait for it forever, so the pool is started here, before anyone signs with our key. Like the
+        # mining pool, it's kept for the lifetime of the node
+        self.sign_pool = None
+        if SIGN_WORKERS > 1:
+            self.sign_pool = worker_context().Pool(SIGN_WORKERS, initializer=_init_signer,
+                                                   initargs=(self.private_key.exportKey(),))
         logger.info('Address generated for node: %s' % self.address())
     
     # address returns the address for this node
     # for simplicity we define address as the public key of this node
     def address(self):
-        # we use a DER dump of the public key to calculate the address. DER is basically a binary dump of the public key.
-        return base64.b64encode(self.private_key.publickey().exportKey('DER')).decode()
+        return self._address
     
+    # set_mining_workers sets the number of processes used for mining. With more than one worker the nonce
+    # search runs on a pool of processes, so it can use all CPU cores and doesn't hold our GIL
+    def set_mining_workers(self, workers):
+        if workers > 1:
+            self.mining_engine = ParallelMiningEngine(workers)
+        else:
+            self.mining_engine = MiningEngine()
+        logger.info('Mining with %d worker(s)' % max(workers, 1))
+
+    # publish makes the current state of our blockchain visible to readers. Call it holding write_lock after a change
+    def publish(self):
+        self.chain = self.blockchain.snapshot()
+
+    # add_block adds a block received from the network to our blockchain, see Blockchain.add_block. A block whose
+    # parent we don't have is kept as an orphan instead (see is_orphan), add_block returns False for it
+    def add_block(self, block):
+        with self.write_lock:
+            if self.is_orphan(block):
+                self.keep_orphan(block)
+                return False
+            if not self.blockchain.add_block(block):
+                return False
+            self.publish()
+            return True
+
+    # is_orphan checks if block goes on top of a block we don't have. The genesis block, and any block while our
+    # blockchain is empty, is never an orphan
+    def is_orphan(self, block):
+        if block.height <= 1 or self.blockchain.get_blockchain_size() == 0:
+            return False
+        return self.blockchain.get_block(block.previous_hash) is None
+
+    # keep_orphan adds block to our orphans if it could go in our blockchain once its parent arrives: it needs
+    # a valid proof of work and should be close enough to our last block. Returns True if it was kept
+    def keep_orphan(self, block):
+        height = self.blockchain.get_last_block().height
+        if not height - MAX_FORK_DEPTH < block.height <= height + self.orphans.maxsize:
+            logger.info('Orphan block %d is too far from our last block %d, dropped' % (block.height, height))
+            return False
+        # we can't check the difficulty of an orphan without its parent, and a proof of work at a difficulty of its
+        # own choosing costs nothing. It can't be easier than any branch of our blockchain could get by its height
+        if block.difficulty < self.min_orphan_difficulty(block.height):
+            logger.error('Orphan block %d is invalid: difficulty %d is too low' % (block.height, block.difficulty))
+            return False
+        block_hash = block.compute_hash()
+        if not block_hash < block.difficulty_to_target():
+            logger.error('Orphan block %d is invalid: hash is %s should be smaller than %s' % (block.height, block_hash, block.difficulty_to_target()))
+            return False
+        if not self.orphans.add(block):
+            return False
+        logger.info('Block %d kept as an orphan, waiting for its parent %s' % (block.height, block.previous_hash))
+        return True
+
+    # min_orphan_difficulty returns the lowest difficulty a block at height could have in our blockchain or in a
+    # branch of it. Branches fork at most MAX_FORK_DEPTH blocks below our last block, and difficulty goes down by
+    # at most one per block after the fork
+    def min_orphan_difficulty(self, height):
+        blocks = self.blockchain.blocks
+        lowest = max(1, len(blocks) - MAX_FORK_DEPTH)
+        return min(blocks[fork - 1].difficulty - (height - fork) for fork in range(lowest, min(height - 1, len(blocks)) + 1))
+
+    # connect_orphans adds the orphans waiting for the block with block_hash, then the ones waiting for those and
+    # so on. Returns the blocks that were added
+    def connect_orphans(self, block_hash):
+        added = []
+        with self.write_lock:
+            waiting = [block_hash]
+            while len(waiting) > 0:
+                for orphan in self.orphans.pop_children(waiting.pop()):
+                    if self.blockchain.add_block(orphan):
+                        logger.info('Orphan block %d added' % orphan.height)
+                        added.append(orphan)
+                        waiting.append(orphan.hash)
+            # orphans too deep below our new last block will never be needed
+            if self.blockchain.get_blockchain_size() > 0:
+                self.orphans.prune(self.blockchain.get_last_block().height - MAX_FORK_DEPTH)
+            if len(added) > 0:
+                self.publish()
+        return added
+
+    # open_store loads our blockchain from the block store in directory, and writes new blocks to it from now on
+    def open_store(self, directory):
+        started = time.time()
+        store = BlockStore(directory)
+        with self.write_lock:
+            self.blockchain.load_from_store(store)
+            self.publish()
+        # make sure the last blocks hit the disk when we exit
+        atexit.register(store.close)
+        logger.info('Loaded %d blocks from %s in %.2f seconds' % (self.blockchain.get_blockchain_size(), directory, time.time() - started))
+
     # find_nonce receives a block and tries nonces until the block hash is smaller than our target (which is
-    # calculated based on difficulty). This actually 'solves' a block!
-    def find_nonce(self, block):
-        # start from zero
-        block.nonce = 0
-        # calculate the block hash
-        current_hash = block.compute_hash()        
-        # try until we find a nonce which solves the block
-        while not current_hash < block.difficulty_to_target():
-            # break from mining of a new block is received while we're mining
-            if self.new_block_received:                
-                break
-            # try the next nonce
-            block.nonce += 1
-            # update the timestamp
-            block.timestamp = time.time()            
-            # calculate the hash again with new nonce
-            current_hash = block.compute_hash()        
+    # calculated based on difficulty). This actually 'solves' a block! refresh is passed to the mining engine,
+    # see refresh_transactions
+    def find_nonce(self, block, refresh=None):
+        # the engine serializes the block once and only changes the nonce and timestamp between attempts.
+        # it stops early if a new block is received while we're mining
+        return self.mining_engine.search(block, lambda: self.new_block_received, refresh)
+
+    # pick_transactions picks the transactions for our next block from the transaction pool, the ones we can't pay
+    # for yet stay in the pool. coinbase_tx goes last
+    def pick_transactions(self, coinbase_tx):
+        self.template_version = self.transaction_pool.version
+        self.template_time = time.time()
+        return self.transaction_pool.select(self.chain.balances) + [coinbase_tx]
+
+    # refresh_transactions is called by the mining engine between nonce batches. If the transaction pool changed
+    # since we picked our block's transactions, and at most once every TEMPLATE_REFRESH_INTERVAL seconds, it returns
+    # a new list of transactions for the block. Returns None otherwise
+    def refresh_transactions(self, coinbase_tx):
+        if self.transaction_pool.version == self.template_version or time.time() - self.template_time < TEMPLATE_REFRESH_INTERVAL:
+            return None
+        logger.info('Transaction pool changed, updating block transactions')
+        return self.pick_transactions(coinbase_tx)
 
     # mine_block mines one block
     def mine_block(self):        
         # if no blocks, create the genesis block
-        if len(self.blockchain.blocks) == 0:
-            self.blockchain.create_genesis_block()
+        if self.chain.get_blockchain_size() == 0:
+            with self.write_lock:
+                self.blockchain.create_genesis_block()
+                self.publish()
             logger.info('Genesis block created!') 
             return True
         else:
+            # we build our block on top of this version of the blockchain
+            chain = self.chain
             # calculate what the next diffculty should be
-            new_block_difficulty = self.blockchain.compute_next_difficulty()        
+            new_block_difficulty = chain.compute_next_difficulty()        
 
-            # add all transactions from the transaction pool to this block
-            tx_list = []
-            for tx in self.transaction_pool:
-                tx_list.append(tx)
+            # create the coinbase transaction, awards BLOCK_REWARD coins to ourselves (the miner)
+            coinbase_tx = Transaction(                    
+                from_pubkey='COINBASE',
+                to_pubkey=self.address(),
+                amount=BLOCK_REWARD)               
+            # sign the coinbase transaction
+            self.sign_transaction(coinbase_tx)
+            # add the transactions from the transaction pool to this block, along with the coinbase transaction
+            tx_list = self.pick_transactions(coinbase_tx)
 
             # create the block
             block_candidate = Block()            
             # set the new blocks fields based on current blockchain
             block_candidate.fill_block(                
-                height=self.blockchain.get_last_block().height + 1, 
+                height=chain.get_last_block().height + 1, 
                 difficulty=new_block_difficulty,
-                previous_hash=self.blockchain.get_last_block().hash, 
+                previous_hash=chain.get_last_block().hash, 
                 transactions=tx_list, 
                 timestamp=time.time())
-            
-            # create the coinbase transaction, awards BLOCK_REWARD coins to ourselves (the miner)
-            coinbase_tx = Transaction(                    
-                from_pubkey='COINBASE',
-                to_pubkey=self.address(),
-                amount=BLOCK_REWARD)               
-            # sign the coinbase transaction
-            self.sign_transaction(coinbase_tx)
-            # add it to the list of transactions for this block
-            block_candidate.transactions.append(coinbase_tx)
 
             logger.info('Mining block %d ... [difficulty=%d] [target=%s]' %
                 (block_candidate.height, block_candidate.difficulty, block_candidate.difficulty_to_target()))
 
-            # find the correct nonce for this block, this takes a while to calculate, hopefully BLOCK_TIME_IN_SECONDS
-            self.find_nonce(block_candidate)
+            # find the correct nonce for this block, this takes a while to calculate, hopefully BLOCK_TIME_IN_SECONDS.
+            # transactions arriving meanwhile are added to the block as we go
+            self.find_nonce(block_candidate, lambda: self.refresh_transactions(coinbase_tx))
 
             # if find_nonce terminated because we received a new block discard the block
             if self.new_block_received:
@@ -111,21 +273,31 @@ class Node:
                 return False
             else:                            
                 # try adding the block to our current blockchain using add_block
-                if not self.blockchain.add_block(block_candidate):            
+                if not self.add_block(block_candidate):            
                     # add_block failed! something was not right in the new block
                     logger.error('Mined block %d discarded!' % block_candidate.height)
+                    # unless another block took its place, its transactions are at fault. Leaving them in the pool
+                    # would have us mine the same invalid block over and over
+                    if block_candidate.previous_hash == self.chain.get_last_block().hash:
+                        for tx in block_candidate.transactions:
+                            if tx.from_pubkey != 'COINBASE' and self.transaction_pool.remove(tx.compute_hash()) is not None:
+                                logger.info('Transaction %s dropped from the pool' % tx.compute_hash())
                     return False
                 else:
-                    # clear the transaction pool. Those transactions are now safely in a block in the blockchain
-                    self.transaction_pool = []
-                    logger.info('Block %d mined!' % block_candidate.height)            
+                    # add_block took our transactions out of the pool, they are now safely in a block in the blockchain
+                    logger.info('Block %d mined! [%.0f hashes/s]' % (block_candidate.height, self.mining_engine.hash_rate()))
                     # mining successful!
                     return True
     
     # new_transaction creates a new transaction and adds it to the transaction pool
     def new_transaction(self, transaction):                        
-        # check if we have enough coins to execute that transaction
-        if not self.address() in self.blockchain.balances or self.blockchain.balances[self.address()] < transaction['amount']:
+        if not valid_amount(transaction['amount']):
+            logger.error('Invalid amount %r!' % (transaction['amount'],))
+            return False
+        # check if we have enough coins to execute that transaction, along with the ones already in the pool
+        balances = self.chain.balances
+        balance = balances.get(self.address(), 0)
+        if balance - self.transaction_pool.pending_debit(self.address()) < transaction['amount']:
             logger.error('You dont have %d!' % transaction['amount'])
             return False
         # create the transaction object
@@ -135,30 +307,282 @@ class Node:
             amount=transaction['amount'])
         # sign it with our private key
         self.sign_transaction(tx)        
-        # add it to the transaction pool, waiting to be mined in a block
-        self.transaction_pool.append(tx)
+        # add it to the transaction pool, waiting to be mined in a block. It's rejected if it's already there
+        if not self.transaction_pool.add(tx, balances):
+            return False
         logger.info('Transaction %d to %s added to transaction pool!' % (transaction['amount'], transaction['to']))
+        # our peers should have it in their pool too
+        if self.relay_transactions is not None:
+            self.relay_transactions([tx])
         # done!
         return True
     
-    # sync_with_dump gets a full blockchain dump and recreates it as an object
-    def sync_with_dump(self, blockchain_dump):        
-        logger.info("Syncing ... dump size: %d current size: %d" %(len(blockchain_dump), self.blockchain.get_blockchain_size()))
+    # new_transactions creates a batch of transactions, each one like new_transaction. The transactions are signed
+    # in parallel and added to the transaction pool all at once. Returns a list with a (tx_hash, error) tuple for
+    # each transaction, error is None if the transaction was added
+    def new_transactions(self, transactions):
+        results = [(None, 'insufficient funds')] * len(transactions)
+        # check we have enough coins for each transaction, along with the ones before it
+        balances = self.chain.balances
+        available = balances.get(self.address(), 0) - self.transaction_pool.pending_debit(self.address())
+        created = []
+        for position, transaction in enumerate(transactions):
+            # an amount we can't compare with our balance only fails its own transaction
+            if not valid_amount(transaction['amount']):
+                results[position] = (None, 'invalid amount')
+                continue
+            if available < transaction['amount']:
+                continue
+            available -= transaction['amount']
+            tx = Transaction(
+                from_pubkey=self.address(),
+                to_pubkey=transaction['to'],
+                amount=transaction['amount'])
+            created.append((position, tx))
+
+        # sign them all, then add them to the pool. The pool checks our balance again, it may have changed meanwhile
+        self.sign_transactions([tx for position, tx in created])
+        added = self.transaction_pool.add_batch([tx for position, tx in created], self.chain.balances)
+        for (position, tx), ok in zip(created, added):
+            results[position] = (tx.compute_hash(), None) if ok else (tx.compute_hash(), 'rejected by the transaction pool')
+        logger.info('%d of %d transactions added to transaction pool!' % (added.count(True), len(transactions)))
+        # our peers should have them in their pool too
+        if self.relay_transactions is not None and True in added:
+            self.relay_transactions([tx for (position, tx), ok in zip(created, added) if ok])
+        return results
+
+    # receive_transactions adds transactions relayed by a peer to our transaction pool. They should have a valid
+    # amount, be signed by their sender, who should have enough coins for them, and not be in our blockchain already.
+    # Returns the transactions that were added
+    def receive_transactions(self, transactions):
+        chain = self.chain
+        valid = []
+        for tx in transactions:
+            if tx.from_pubkey == 'COINBASE' or tx.compute_hash() in self.transaction_pool or tx.compute_hash() in chain.tx_index:
+                continue
+            # a block with this transaction would be rejected, and so would every block our miner builds with it
+            if not valid_amount(tx.amount) or tx.from_pubkey not in chain.balances:
+                logger.error('Transaction %s rejected: invalid amount or sender without coins' % tx.compute_hash())
+                continue
+            try:
+                if tx.verify_signature():
+                    valid.append(tx)
+            except Exception:
+                # a key we can't even load is not a valid signature
+                logger.error('Transaction %s rejected: invalid signature' % tx.compute_hash())
+        added = self.transaction_pool.add_batch(valid, chain.balances)
+        return [tx for tx, ok in zip(valid, added) if ok]
+
+    # sync_with_dump gets a full blockchain dump and recreates it as an object. The dump can be any iterable of block
+    # dumps, like a stream from a peer, in that case give its size in dump_size. Blocks are checked as they arrive,
+    # without holding our lock, so we keep adding blocks meanwhile. The lock is only taken to switch blockchains.
+    # The new blockchain should be longer than ours, or heavier if by_work is set. Returns True if we switched
+    def sync_with_dump(self, blockchain_dump, dump_size=None, by_work=False):        
+        if dump_size is None:
+            dump_size = len(blockchain_dump)
+        logger.info("Syncing ... dump size: %d current size: %d" %(dump_size, self.chain.get_blockchain_size()))
         # new blockchain should be longer than our own
-        if len(blockchain_dump) > self.blockchain.get_blockchain_size():
-            # create the Blockchain
-            new_blockchain = Blockchain()            
-            # use load_from to load the blockchain
-            if new_blockchain.load_from(blockchain_dump):                
-                # load_from was successful, set the nodes blockchain to the new one just parsed
-                self.blockchain = new_blockchain
-                # restart the miner if running
-                self.new_block_received = True
-        else:
+        if not by_work and dump_size <= self.chain.get_blockchain_size():
             logger.info('Did not sync!')
+            return False
+        # create the Blockchain
+        new_blockchain = Blockchain()            
+        # use load_from to load the blockchain
+        if not new_blockchain.load_from(blockchain_dump):
+            return False
+
+        with self.write_lock:
+            # we may have added blocks while loading the dump
+            if by_work:
+                better = new_blockchain.get_total_work() > self.blockchain.get_total_work()
+            else:
+                better = new_blockchain.get_blockchain_size() > self.blockchain.get_blockchain_size()
+            if not better:
+                logger.info('New blockchain is not better than ours, did not sync!')
+                return False
+            # load_from was successful, our block store (if we have one) now keeps the new blockchain
+            if self.blockchain.store is not None:
+                new_blockchain.attach_store(self.blockchain.store)
+            # transactions of our blocks that are not in the new blockchain go back to the pool, and the
+            # transactions in the new blockchain leave it
+            for block in self.blockchain.blocks:
+                if not new_blockchain.is_main_block(block.height, block.hash):
+                    self.transaction_pool.add_transactions([tx for tx in block.transactions if tx.compute_hash() not in new_blockchain.tx_index])
+            for tx in self.transaction_pool:
+                if tx.compute_hash() in new_blockchain.tx_index:
+                    self.transaction_pool.remove(tx.compute_hash())
+            new_blockchain.mempool = self.transaction_pool
+            # set the nodes blockchain to the new one just parsed
+            self.blockchain = new_blockchain
+            self.publish()
+            # restart the miner if running
+            self.new_block_received = True
+            return True
     
+    # find_common_ancestor returns the height of the last block of chain (a version of our blockchain) we have in
+    # common with a peer, 0 if we don't have any. fetch_headers(start, end) returns the peer's block headers with
+    # heights from start to end
+    def find_common_ancestor(self, chain, fetch_headers):
+        end = chain.get_blockchain_size()
+        window = SYNC_WINDOW
+        while end > 0:
+            start = max(1, end - window + 1)
+            # check the peer's blocks from the highest one down. blocks are chained by hashes, so if the peer's
+            # block at some height is the same as ours, all blocks before it are the same too
+            for header in reversed(fetch_headers(start, end)):
+                if start <= header.height <= end and header.compute_hash() == chain.blocks[header.height - 1].hash:
+                    return header.height
+            # look further back
+            end = start - 1
+            window = min(window * 2, SYNC_PAGE_SIZE)
+        return 0
+
+    # fetch_headers_after downloads and checks the peer's block headers from ancestor + 1 to peer_height, following
+    # block ancestor of chain. Returns the list of headers, or None if the peer sent invalid ones
+    def fetch_headers_after(self, chain, fetch_headers, ancestor, peer_height):
+        headers = []
+        # the last two blocks before the headers, the difficulty of a block depends on them
+        previous = chain.blocks[max(ancestor - 2, 0):ancestor]
+        while ancestor + len(headers) < peer_height:
+            start = ancestor + len(headers) + 1
+            page = fetch_headers(start, min(peer_height, start + SYNC_HEADER_PAGE_SIZE - 1))
+            if len(page) == 0 or not check_headers(page, previous):
+                return None
+            headers.extend(page)
+            previous = (previous + page)[-2:]
+        return headers
+
+    # fetch_bodies returns the full blocks for a list of checked headers. Blocks chain (a version of our blockchain)
+    # has on a side branch are reused, the others are downloaded with fetch_blocks and must match their header.
+    # Returns None if the peer didn't send the right blocks
+    def fetch_bodies(self, chain, headers, fetch_blocks):
+        blocks = [chain.side_blocks.get(header.hash) for header in headers]
+        missing = [i for i, block in enumerate(blocks) if block is None]
+        if len(missing) > 0:
+            fetched = {block.height: block for block in fetch_blocks(headers[missing[0]].height, headers[missing[-1]].height)}
+            for i in missing:
+                block = fetched.get(headers[i].height)
+                # the transactions should be the ones the header commits to
+                if block is None or block.merkle_root() != headers[i].merkle_root() or block.compute_hash() != headers[i].hash:
+                    logger.error('Peer sent a block that does not match header %d' % headers[i].height)
+                    return None
+                blocks[i] = block
+        return blocks
+
+    # sync_with_peer syncs our blockchain with a heavier one from a peer. Instead of downloading and checking the
+    # whole blockchain, it finds the last block we have in common, downloads and checks the peer's headers after it,
+    # and only then downloads the missing blocks, replacing our blocks after the common ancestor.
+    # fetch_headers(start, end) and fetch_blocks(start, end) return the peer's headers and blocks with heights from
+    # start to end. peer_height and peer_work are the height and total work of the peer's last block.
+    # Everything is downloaded without holding our lock, so we keep adding blocks meanwhile. The lock is only taken
+    # to replace our last blocks. If we have no blocks in common with the peer, fetch_chain() (if given) returns the
+    # size of the peer's blockchain and a stream of its block dumps, which are checked as they arrive instead
+    def sync_with_peer(self, fetch_headers, fetch_blocks, peer_height, peer_work, fetch_chain=None):
+        # the version of our blockchain we compare the peer's blocks to
+        chain = self.chain
+        current_size = chain.get_blockchain_size()
+        current_work = chain.get_total_work()
+        logger.info('Syncing ... peer size: %d current size: %d' % (peer_height, current_size))
+        # peer's blockchain should be heavier than our own
+        if peer_work <= current_work:
+            logger.info('Did not sync!')
+            return False
+
+        try:
+            ancestor = self.find_common_ancestor(chain, fetch_headers)
+            # we'd download the whole blockchain anyway, stream it instead of holding all of it before checking it.
+            # We can't undo blocks older than our balance history either (see prune_balance_history)
+            if (ancestor == 0 or ancestor < chain.history_start) and fetch_chain is not None:
+                logger.info('No recent blocks in common with the peer, downloading its whole blockchain')
+                chain_size, blockchain_dump = fetch_chain()
+                return self.sync_with_dump(blockchain_dump, chain_size, by_work=True)
+            if ancestor < chain.history_start:
+                logger.error('Common ancestor %d is older than our balance history, did not sync!' % ancestor)
+                return False
+            headers = self.fetch_headers_after(chain, fetch_headers, ancestor, peer_height)
+            # the headers tell us how much work the peer's blockchain really has, before we download any transactions
+            if headers is None or len(headers) == 0 or headers[-1].total_work <= current_work:
+                logger.error('Peer headers are invalid or not heavier than our blockchain, did not sync!')
+                return False
+            # download the peer's blocks, one page at a time
+            blocks = []
+            for i in range(0, len(headers), SYNC_PAGE_SIZE):
+                page = self.fetch_bodies(chain, headers[i:i + SYNC_PAGE_SIZE], fetch_blocks)
+                # stop if the peer sent invalid blocks
+                if page is None:
+                    logger.error('Sync failed! Keeping our blockchain')
+                    return False
+                blocks.extend(page)
+        except requests.exceptions.RequestException as e:
+            logger.error('Could not download blocks: %s' % e)
+            return False
+
+        # our blockchain can't change while we replace its last blocks
+        with self.write_lock:
+            # we may have added blocks while downloading. The peer's blocks still follow our block ancestor, and
+            # should still be heavier than ours
+            if ancestor > 0 and not self.blockchain.is_main_block(ancestor, chain.blocks[ancestor - 1].hash):
+                logger.info('Block %d is not in our blockchain anymore, did not sync!' % ancestor)
+                return False
+            if ancestor < self.blockchain.history_start:
+                logger.info('Block %d is older than our balance history now, did not sync!' % ancestor)
+                return False
+            if headers[-1].total_work <= self.blockchain.get_total_work():
+                logger.info('Our blockchain is as heavy as the peer\'s now, did not sync!')
+                return False
+            logger.info('Common ancestor is block %d, replacing %d block(s)' % (ancestor, self.blockchain.get_blockchain_size() - ancestor))
+            # remove our blocks after the common ancestor, we keep them in case the peer's blocks are invalid
+            removed = self.blockchain.rollback_to(ancestor)
+            # these blocks are about to join our blockchain
+            for header in headers:
+                self.blockchain.side_blocks.pop(header.hash, None)
+
+            # add the peer's blocks, one page at a time
+            synced = True
+            for i in range(0, len(blocks), SYNC_PAGE_SIZE):
+                if not self.blockchain.add_blocks(blocks[i:i + SYNC_PAGE_SIZE]):
+                    synced = False
+                    break
+
+            # if something went wrong put our own blocks back
+            if not synced:
+                logger.error('Sync failed! Restoring our blockchain')
+                self.blockchain.rollback_to(ancestor)
+                self.blockchain.add_blocks(removed)
+                return False
+
+            self.publish()
+            logger.info('Synced successfully!')
+            # restart the miner if running
+            self.new_block_received = True
+            return True
+
+    # get_sign_pool returns the pool of processes used to sign transactions
+    def get_sign_pool(self):
+        return self.sign_pool
+
+    # sign_transactions signs a list of transactions using the nodes private key. Long lists are signed in parallel
+    def sign_transactions(self, transactions):
+        tx_hashes = [tx.compute_hash() for tx in transactions]
+        signatures = map_batches(_sign_batch, tx_hashes, SIGN_BATCH_SIZE, PARALLEL_SIGN_THRESHOLD, SIGN_WORKERS,
+                                 self.get_sign_pool, self.sign_hashes)
+        for tx, signature in zip(transactions, signatures):
+            tx.signature = signature
+            # we just made this signature, no need to verify it when the transaction comes back to us in a block
+            signature_cache.put((tx.compute_hash(), tx.signature), True)
+            # signed transactions don't change anymore
+            tx.seal()
+
+    # sign_hashes signs a list of transaction hashes right here, using the nodes private key
+    def sign_hashes(self, tx_hashes):
+        return [self.private_key.sign(tx_hash.encode(), '')[0] for tx_hash in tx_hashes]
+
     # sign_transaction signs a transaction using the nodes private key
     def sign_transaction(self, tx):                
         # RSA sign
         tx.signature = self.private_key.sign(tx.compute_hash().encode(),'')[0]   
+        # we just made this signature, no need to verify it when the transaction comes back to us in a block
+        signature_cache.put((tx.compute_hash(), tx.signature), True)
+        # signed transactions don't change anymore
+        tx.seal()
 
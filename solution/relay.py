@@ -0,0 +1,161 @@
+# relay.py provides the queues our node relays blocks and transactions to its peers from. Blocks are put on the
+# queue as soon as they are accepted and sent by background threads, so whoever gave us the block doesn't wait for
+# us to send it to everyone else, and each hop of the network only adds the time it takes to check a block
+
+from collections import deque, OrderedDict
+import threading
+import time
+import logging
+
+# get logger to print stuff
+logger = logging.getLogger()
+
+# the queue holds at most this many blocks waiting to be relayed. When it's full the oldest block is dropped,
+# peers are more interested in the newest ones (and can download the parents they miss from us)
+RELAY_QUEUE_SIZE = 256
+
+# number of threads relaying blocks. Each one sends a block to all peers at once (see network.fan_out). With a
+# single thread blocks are relayed in the order they were added, so peers get parents before their children
+RELAY_WORKERS = 1
+
+# the RelayQueue class is a bounded queue of blocks to relay, drained by worker threads calling send(block, skip)
+class RelayQueue:
+    # constructor
+    def __init__(self, send, workers=RELAY_WORKERS, maxsize=RELAY_QUEUE_SIZE):
+        self.send = send
+        self.workers = workers
+        self.maxsize = maxsize
+        # (block, skip, time it was queued at) for each block waiting to be relayed
+        self.items = deque()
+        self.condition = threading.Condition()
+        # the worker threads, started the first time a block is queued
+        self.threads = []
+        # counters for /stats
+        self.queued = 0
+        self.relayed = 0
+        self.dropped = 0
+        self.failed = 0
+        # seconds between queueing a block and having it sent to all peers, in total and for the slowest block
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    # put queues a block to be relayed to all peers except those in skip. Returns right away
+    def put(self, block, skip=()):
+        with self.condition:
+            if len(self.threads) == 0:
+                self.start()
+            if len(self.items) >= self.maxsize:
+                dropped, _, _ = self.items.popleft()
+                self.dropped += 1
+                logger.info('Relay queue is full, block %d dropped' % dropped.height)
+            self.items.append((block, skip, time.time()))
+            self.queued += 1
+            self.condition.notify()
+
+    # start starts the worker threads, they run as long as our node does
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='relay-%d' % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # work relays queued blocks, one at a time
+    def work(self):
+        while True:
+            with self.condition:
+                while len(self.items) == 0:
+                    self.condition.wait()
+                block, skip, queued_at = self.items.popleft()
+            try:
+                self.send(block, skip)
+            except Exception as e:
+                # keep the worker going, the next block may have better luck
+                self.failed += 1
+                logger.error('Could not relay block %d: %s' % (block.height, e))
+                continue
+            latency = time.time() - queued_at
+            with self.condition:
+                self.relayed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    # stats returns the number of blocks waiting along with counters and relay latencies in milliseconds
+    def stats(self):
+        with self.condition:
+            return {'depth': len(self.items), 'maxsize': self.maxsize, 'queued': self.queued,
+                    'relayed': self.relayed, 'dropped': self.dropped, 'failed': self.failed,
+                    'avg_latency_ms': self.total_latency / self.relayed * 1000 if self.relayed > 0 else 0.0,
+                    'max_latency_ms': self.max_latency * 1000}
+
+# the transaction relay queue holds at most this many transactions waiting to be relayed, the oldest are dropped
+TX_RELAY_QUEUE_SIZE = 10000
+
+# seconds the transaction relay waits for more transactions before sending. Transactions arriving meanwhile are
+# sent to each peer in a single request, instead of one request per transaction per peer
+TX_RELAY_DELAY = 0.1
+
+# the TransactionRelayQueue class is a bounded queue of transactions to relay, drained by its own worker thread so
+# relaying transactions never waits for (or holds up) block downloads. The worker takes all transactions waiting
+# at once and calls send(batch) with a list of (transaction, skip)
+class TransactionRelayQueue:
+    # constructor
+    def __init__(self, send, delay=TX_RELAY_DELAY, maxsize=TX_RELAY_QUEUE_SIZE):
+        self.send = send
+        self.delay = delay
+        self.maxsize = maxsize
+        # transaction hash to (transaction, skip) for each transaction waiting to be relayed, oldest first
+        self.items = OrderedDict()
+        self.condition = threading.Condition()
+        # the worker thread, started the first time a transaction is queued
+        self.thread = None
+        # counters for /stats
+        self.queued = 0
+        self.batches = 0
+        self.relayed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    # put queues transactions to be relayed to all peers except those in skip. Returns right away
+    def put(self, transactions, skip=()):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='tx-relay', daemon=True)
+                self.thread.start()
+            for tx in transactions:
+                # a transaction already waiting is only sent once
+                if tx.compute_hash() in self.items:
+                    continue
+                if len(self.items) >= self.maxsize:
+                    self.items.popitem(last=False)
+                    self.dropped += 1
+                self.items[tx.compute_hash()] = (tx, skip)
+                self.queued += 1
+            self.condition.notify()
+
+    # work relays the queued transactions, all the ones waiting at once
+    def work(self):
+        while True:
+            with self.condition:
+                while len(self.items) == 0:
+                    self.condition.wait()
+            # let more transactions arrive, they go in the same requests
+            time.sleep(self.delay)
+            with self.condition:
+                batch = list(self.items.values())
+                self.items.clear()
+            try:
+                self.send(batch)
+            except Exception as e:
+                # keep the worker going, the next batch may have better luck
+                self.failed += len(batch)
+                logger.error('Could not relay %d transactions: %s' % (len(batch), e))
+                continue
+            with self.condition:
+                self.batches += 1
+                self.relayed += len(batch)
+
+    # stats returns the number of transactions waiting along with counters
+    def stats(self):
+        with self.condition:
+            return {'depth': len(self.items), 'maxsize': self.maxsize, 'queued': self.queued, 'batches': self.batches,
+                    'relayed': self.relayed, 'dropped': self.dropped, 'failed': self.failed}
@@ -0,0 +1,118 @@
+# store.py provides an append-only block log on disk. The node writes every block it adds to its blockchain
+# here, so when it restarts it can load its own blocks instead of downloading the whole blockchain from peers
+
+import os
+import mmap
+import time
+import struct
+import logging
+
+# get logger to print stuff
+logger = logging.getLogger()
+
+# blocks are appended to the data file, each one as a 4 bytes length followed by its JSON dump
+DATA_FILE = 'blocks.dat'
+RECORD_HEADER = struct.Struct('>I')
+# the index file has one fixed size entry per block: height, hash, offset of the record in the data file and
+# length of the JSON dump. It lets us find any block without reading the data file
+INDEX_FILE = 'blocks.idx'
+INDEX_ENTRY = struct.Struct('>Q32sQI')
+
+# fsync is slow, so we only force blocks to disk every FSYNC_BATCH blocks or FSYNC_INTERVAL seconds.
+# if the node crashes we lose at most that many blocks, which we can download again from peers
+FSYNC_BATCH = 16
+FSYNC_INTERVAL = 1.0
+
+# the BlockStore class is an append-only log of blocks along with an index by height and hash
+class BlockStore:
+    # constructor, directory is where our files live. It's created if it doesn't exist
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.data_file = open(self.data_path, 'ab+')
+        self.index_file = open(self.index_path, 'ab+')
+        # the index is small, we keep all of it in memory as a list of (height, hash, offset, length)
+        self.index = []
+        # blocks appended since the last fsync
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.read_index()
+
+    # read_index loads the index file. If we crashed while writing, the files may end with a partial
+    # record, in that case we cut both files after the last complete block
+    def read_index(self):
+        self.index_file.seek(0)
+        index_data = self.index_file.read()
+        data_size = os.path.getsize(self.data_path)
+        for position in range(0, len(index_data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            height, block_hash, offset, length = INDEX_ENTRY.unpack_from(index_data, position)
+            # this block didn't make it to the data file
+            if offset + RECORD_HEADER.size + length > data_size:
+                break
+            self.index.append((height, block_hash.hex(), offset, length))
+        self.truncate(len(self.index))
+
+    # get_size returns the number of blocks in the store
+    def get_size(self):
+        return len(self.index)
+
+    # get_hash returns the hash of the block at height
+    def get_hash(self, height):
+        return self.index[height - 1][1]
+
+    # append adds a block at the end of the log. The block should be the next one after our last block
+    def append(self, block):
+        block_data = str(block).encode()
+        offset = self.data_file.seek(0, os.SEEK_END)
+        self.data_file.write(RECORD_HEADER.pack(len(block_data)) + block_data)
+        self.index_file.write(INDEX_ENTRY.pack(block.height, bytes.fromhex(block.hash), offset, len(block_data)))
+        self.index.append((block.height, block.hash, offset, len(block_data)))
+
+        # fsync once in a while
+        self.unsynced += 1
+        if self.unsynced >= FSYNC_BATCH or time.time() - self.last_sync >= FSYNC_INTERVAL:
+            self.sync()
+
+    # truncate removes blocks from the end of the log until it has size blocks
+    def truncate(self, size):
+        if size < len(self.index):
+            data_size = self.index[size][2]
+        elif size > 0:
+            height, block_hash, offset, length = self.index[size - 1]
+            data_size = offset + RECORD_HEADER.size + length
+        else:
+            data_size = 0
+        self.index = self.index[:size]
+        self.data_file.truncate(data_size)
+        self.index_file.truncate(size * INDEX_ENTRY.size)
+        self.sync()
+
+    # sync forces everything we've written to disk. The data file goes first, so the index never points
+    # at a block that's not on disk
+    def sync(self):
+        for f in (self.data_file, self.index_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    # read_blocks yields the JSON dumps of all blocks in the log, in order, as bytes. The data file is
+    # memory-mapped, so the operating system reads it for us as we go
+    def read_blocks(self):
+        self.data_file.flush()
+        if len(self.index) == 0:
+            return
+        with mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for height, block_hash, offset, length in self.index:
+                start = offset + RECORD_HEADER.size
+                # decoding is left to the caller, a damaged record shouldn't stop us here
+                yield data[start:start + length]
+
+    # close syncs and closes our files
+    def close(self):
+        if self.data_file.closed:
+            return
+        self.sync()
+        self.data_file.close()
+        self.index_file.close()
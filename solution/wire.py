@@ -0,0 +1,197 @@
+# wire.py provides a compact binary encoding for blocks and transactions. Our JSON format dumps each transaction
+# as a JSON string inside the block's JSON, so it's escaped and parsed twice, and addresses travel as ~400
+# characters of base64. The binary format is length-prefixed and keeps keys, hashes and signatures as raw bytes.
+# Decoding gives back exactly the same values, so block and transaction hashes don't change
+
+import struct
+import zlib
+import base64
+import binascii
+
+from blockchain import Block, Transaction
+
+# content types for the binary format, plain and zlib compressed. JSON stays the default
+BINARY_CONTENT_TYPE = 'application/x-blockchain'
+COMPRESSED_CONTENT_TYPE = 'application/x-blockchain-zlib'
+BINARY_CONTENT_TYPES = (COMPRESSED_CONTENT_TYPE, BINARY_CONTENT_TYPE)
+
+# a compressed message may decompress to at most this many bytes. A few kilobytes of zlib can decompress to
+# gigabytes, we don't want a peer to make us hold that in memory
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# the first byte of every message, bump it if the format changes
+VERSION = 1
+
+# every value is written as a one byte tag followed by its data
+TAG_INT = 0     # signed big-endian integer, 2 bytes length
+TAG_FLOAT = 1   # 8 bytes double, so floats (like timestamps) come back exactly the same
+TAG_STR = 2     # utf-8 string, 4 bytes length
+TAG_BASE64 = 3  # a base64 string (like an address) sent as the raw bytes it encodes, 2 bytes length
+TAG_HEX = 4     # a lowercase hex string (like a hash) sent as raw bytes, 1 byte length
+
+BYTE = struct.Struct('>B')
+SHORT = struct.Struct('>H')
+LONG = struct.Struct('>I')
+DOUBLE = struct.Struct('>d')
+
+# _is_base64 checks if value is a base64 string that decodes and encodes back to exactly the same string
+def _is_base64(value):
+    try:
+        return len(value) > 0 and base64.b64encode(base64.b64decode(value, validate=True)).decode() == value
+    except (binascii.Error, ValueError):
+        return False
+
+# _is_hex checks if value is a lowercase hex string that decodes and encodes back to exactly the same string
+def _is_hex(value):
+    try:
+        return len(value) > 0 and len(value) < 512 and bytes.fromhex(value).hex() == value
+    except ValueError:
+        return False
+
+# _pack_value encodes a single int, float or string
+def _pack_value(value):
+    # bool is an int in Python, but it's not something we send
+    if isinstance(value, bool):
+        raise ValueError('unsupported value %r' % value)
+    if isinstance(value, int):
+        data = value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+        return BYTE.pack(TAG_INT) + SHORT.pack(len(data)) + data
+    if isinstance(value, float):
+        return BYTE.pack(TAG_FLOAT) + DOUBLE.pack(value)
+    if isinstance(value, str):
+        if _is_hex(value):
+            data = bytes.fromhex(value)
+            return BYTE.pack(TAG_HEX) + BYTE.pack(len(data)) + data
+        if _is_base64(value):
+            data = base64.b64decode(value)
+            if len(data) <= 0xffff:
+                return BYTE.pack(TAG_BASE64) + SHORT.pack(len(data)) + data
+        data = value.encode()
+        return BYTE.pack(TAG_STR) + LONG.pack(len(data)) + data
+    raise ValueError('unsupported value %r' % value)
+
+# the _Reader class reads values from a binary message
+class _Reader:
+    # constructor
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    # read returns the next size bytes
+    def read(self, size):
+        if self.offset + size > len(self.data):
+            raise ValueError('message is too short')
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return chunk
+
+    # unpack reads a struct
+    def unpack(self, fmt):
+        return fmt.unpack(self.read(fmt.size))[0]
+
+    # value reads a value written by _pack_value
+    def value(self):
+        tag = self.unpack(BYTE)
+        if tag == TAG_INT:
+            return int.from_bytes(self.read(self.unpack(SHORT)), 'big', signed=True)
+        if tag == TAG_FLOAT:
+            return self.unpack(DOUBLE)
+        if tag == TAG_STR:
+            return self.read(self.unpack(LONG)).decode()
+        if tag == TAG_BASE64:
+            return base64.b64encode(self.read(self.unpack(SHORT))).decode()
+        if tag == TAG_HEX:
+            return self.read(self.unpack(BYTE)).hex()
+        raise ValueError('unknown tag %d' % tag)
+
+    # record reads a length-prefixed record and returns a reader for it
+    def record(self):
+        return _Reader(self.read(self.unpack(LONG)))
+
+# _pack_record prefixes data with its length
+def _pack_record(data):
+    return LONG.pack(len(data)) + data
+
+# encode_transaction encodes a transaction
+def encode_transaction(tx):
+    return b''.join(_pack_value(value) for value in (tx.from_pubkey, tx.to_pubkey, tx.amount, tx.signature))
+
+# _read_transaction reads a transaction
+def _read_transaction(reader):
+    tx = Transaction(
+        from_pubkey=reader.value(),
+        to_pubkey=reader.value(),
+        amount=reader.value())
+    tx.signature = reader.value()
+    # the transaction is complete, it won't change anymore
+    return tx.seal()
+
+# _pack_block encodes a block without the version byte
+def _pack_block(block):
+    header = b''.join(_pack_value(value) for value in
+        (block.height, block.difficulty, block.nonce, block.previous_hash, block.timestamp))
+    transactions = b''.join(_pack_record(encode_transaction(tx)) for tx in block.transactions)
+    return header + LONG.pack(len(block.transactions)) + transactions
+
+# _read_block reads a block written by _pack_block
+def _read_block(reader):
+    height, difficulty, nonce, previous_hash, timestamp = [reader.value() for _ in range(5)]
+    transactions = [_read_transaction(reader.record()) for _ in range(reader.unpack(LONG))]
+    block = Block()
+    block.fill_block(height, difficulty, previous_hash, transactions, timestamp)
+    block.nonce = nonce
+    # the block is complete, it won't change anymore
+    return block.seal()
+
+# _finish adds the version byte and compresses the message if asked to
+def _finish(data, compress):
+    data = BYTE.pack(VERSION) + data
+    if compress:
+        return zlib.compress(data)
+    return data
+
+# _start decompresses a message if needed, checks the version byte and returns a reader for the rest
+def _start(data, compressed):
+    try:
+        if compressed:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(data, MAX_MESSAGE_SIZE)
+            # there's more to decompress than we accept
+            if decompressor.unconsumed_tail:
+                raise ValueError('compressed message is bigger than %d bytes' % MAX_MESSAGE_SIZE)
+    except zlib.error:
+        raise ValueError('invalid compressed message')
+    reader = _Reader(data)
+    version = reader.unpack(BYTE)
+    if version != VERSION:
+        raise ValueError('unsupported version %d' % version)
+    return reader
+
+# encode_block encodes a block as a binary message
+def encode_block(block, compress=False):
+    return _finish(_pack_block(block), compress)
+
+# decode_block decodes a binary message written by encode_block. Raises ValueError if the message is invalid
+def decode_block(data, compressed=False):
+    try:
+        return _read_block(_start(data, compressed))
+    except (struct.error, UnicodeDecodeError):
+        raise ValueError('invalid block message')
+
+# encode_chain encodes a blockchain size, a list of peers and a list of blocks (like /info returns) as a binary message
+def encode_chain(chain_size, peers, blocks, compress=False):
+    data = _pack_value(chain_size) + LONG.pack(len(peers)) + b''.join(_pack_value(peer) for peer in peers)
+    data += LONG.pack(len(blocks)) + b''.join(_pack_record(_pack_block(block)) for block in blocks)
+    return _finish(data, compress)
+
+# decode_chain decodes a binary message written by encode_chain. It returns a dict with 'chain_size', 'peers'
+# and 'blocks' (a list of Block objects). Raises ValueError if the message is invalid
+def decode_chain(data, compressed=False):
+    try:
+        reader = _start(data, compressed)
+        chain_size = reader.value()
+        peers = [reader.value() for _ in range(reader.unpack(LONG))]
+        blocks = [_read_block(reader.record()) for _ in range(reader.unpack(LONG))]
+    except (struct.error, UnicodeDecodeError):
+        raise ValueError('invalid chain message')
+    return {'chain_size': chain_size, 'peers': peers, 'blocks': blocks}
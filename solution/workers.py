@@ -0,0 +1,24 @@
+# workers.py provides what our pools of worker processes share: picking how to start the processes, and splitting
+# a list of work into batches for them. Mining, signing and checking signatures all run on such pools
+
+import multiprocessing
+
+# worker_context returns the multiprocessing context to start worker processes with. fork is the cheapest way to
+# start them, use it where the platform supports it. A forked process gets a copy of every lock of ours though, and
+# one held by another of our threads at the time is never released in it. Workers must not use those (see
+# blockchain._init_verifier), or the pool must be started before any other thread could be holding them
+def worker_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+# map_batches calls function on a list of items and returns its results, one per item and in the same order.
+# function takes a list of items and returns a list of results. Long lists are split in batches of batch_size and
+# sent to the pool returned by get_pool. With fewer than threshold items, or fewer than 2 workers, sending them to
+# other processes costs more than it saves, so local is called with all of them right here
+def map_batches(function, items, batch_size, threshold, workers, get_pool, local=None):
+    if len(items) < threshold or workers < 2:
+        return (local or function)(items)
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    # map keeps the order of batches, so results line up with items
+    return [result for batch_results in get_pool().map(function, batches) for result in batch_results]